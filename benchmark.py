@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+
+# Benchmark harness for mkabook
+#
+# Generates a synthetic library of audio-books from ffmpeg's sine and noise
+# sources, then times single item and batch processing across codecs and job
+# counts. Throughput is reported in audio-hours processed per wall-hour, and
+# can be saved as a baseline to compare later runs against.
+
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mkabook
+
+# File extension and ffmpeg encoder used for each kind of generated input
+INPUT_FORMATS = {
+    "mp3": (".mp3", ["-acodec", "libmp3lame", "-b:a", "64k"]),
+    "aac": (".m4a", ["-acodec", "aac", "-b:a", "64k"]),
+    "flac": (".flac", ["-acodec", "flac"]),
+    "ogg": (".ogg", ["-acodec", "libvorbis", "-q:a", "3"]),
+}
+
+
+################################################################################
+#  Library Generation                                                          #
+################################################################################
+
+# Build (or reuse) a library of `books` directories, each holding `files`
+# inputs of `duration` seconds
+def generate_library(root, books, files, duration, source, input_codec, channels):
+    params = {
+        "books": books,
+        "files": files,
+        "duration": duration,
+        "source": source,
+        "input_codec": input_codec,
+        "channels": channels,
+    }
+
+    # Generating is slow for long books, so keep a library around if it
+    # was made with the same parameters
+    params_file = os.path.join(root, "library.json")
+    try:
+        with open(params_file, "r") as f:
+            if json.load(f) == params:
+                return
+    except (OSError, ValueError):
+        pass
+
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+
+    (ext, encoder) = INPUT_FORMATS[input_codec]
+    jobs = []
+    for book in range(books):
+        book_dir = os.path.join(root, "Book {:03}".format(book + 1))
+        os.makedirs(book_dir)
+        for part in range(files):
+            # Vary the tone so inputs don't all have identical content
+            if source == "sine":
+                lavfi = "sine=frequency={}:sample_rate=44100:duration={}".format(
+                    220 + 10 * book + part, duration)
+            else:
+                lavfi = "anoisesrc=color=pink:amplitude=0.1:sample_rate=44100:seed={}:duration={}".format(
+                    book * files + part, duration)
+            jobs.append(["ffmpeg", "-nostdin", "-v", "error", "-y", "-f", "lavfi", "-i", lavfi, "-ac", str(channels)] +
+                        encoder + [os.path.join(book_dir, "Part {:03}{}".format(part + 1, ext))])
+
+    mkabook.progress_msg("Generating {} books of {} x {}s {} files".format(
+        books, files, duration, input_codec))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=mkabook.available_cores()) as pool:
+        for proc in pool.map(lambda x: subprocess.run(x), jobs):
+            if proc.returncode != 0:
+                raise Exception("Failed to generate the library")
+
+    with open(params_file, "w") as f:
+        json.dump(params, f)
+
+
+################################################################################
+#  Benchmarks                                                                  #
+################################################################################
+
+# Run mkabook with the given command line, returning the wall time and the
+# results of every item
+def run_case(argv, batch):
+    args = mkabook.parse_args(argv)
+
+    # Keep mkabook's own reporting out of the benchmark output
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            start = time.monotonic()
+            if batch:
+                results = [x[1] for x in mkabook.handle_batch(args)]
+            else:
+                try:
+                    results = [mkabook.handle_single(args, output_args={
+                        "prefix": None,
+                        "verbose_output": False,
+                        "dynamic_output": False,
+                    })]
+                except Exception as e:
+                    results = [e]
+            wall = time.monotonic() - start
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise Exception("{} failed: {}".format(" ".join(argv), result))
+
+    return wall
+
+
+def run_benchmarks(opts, library):
+    books = sorted([os.path.join(library, x) for x in os.listdir(library)
+                    if os.path.isdir(os.path.join(library, x))])
+    book_hours = opts.files * opts.duration / 3600
+    results = []
+
+    def record(name, mode, codec, jobs, wall, hours):
+        result = {
+            "name": name,
+            "mode": mode,
+            "codec": codec,
+            "jobs": jobs,
+            "wall_time": wall,
+            "audio_hours": hours,
+            "throughput": hours / (wall / 3600),
+        }
+        mkabook.good_msg("{}: {:.2f}s, {:.1f} audio-hours/hour".format(
+            name, wall, result["throughput"]))
+        results.append(result)
+
+    for codec in opts.codecs:
+        for _ in range(opts.repeat):
+            with tempfile.TemporaryDirectory(prefix="mkabook-bench") as out_dir:
+                wall = run_case(["--ignore-cfg", "--codec", codec,
+                                 "-o", out_dir, books[0]], False)
+            record("single/{}".format(codec), "single",
+                   codec, 1, wall, book_hours)
+
+        for jobs in opts.jobs:
+            for _ in range(opts.repeat):
+                with tempfile.TemporaryDirectory(prefix="mkabook-bench") as out_dir:
+                    wall = run_case(["--ignore-cfg", "--codec", codec, "--batch", "-j", str(jobs),
+                                     "-o", out_dir, library], True)
+                record("batch/{}/j{}".format(codec, jobs), "batch",
+                       codec, jobs, wall, book_hours * len(books))
+
+    return results
+
+
+# Keep the best of repeated runs of the same case
+def best_results(results):
+    best = {}
+    for result in results:
+        if result["name"] not in best or result["wall_time"] < best[result["name"]]["wall_time"]:
+            best[result["name"]] = result
+    return [best[x] for x in sorted(best)]
+
+
+# Compare against a stored baseline, returns the number of regressions
+def compare_baseline(results, baseline, tolerance):
+    print("\n" + mkabook.bcolors.HEADER +
+          "Compared to baseline" + mkabook.bcolors.ENDC)
+    previous = {x["name"]: x for x in baseline["results"]}
+    regressions = 0
+    for result in results:
+        if result["name"] not in previous:
+            mkabook.warn_msg("{}: not in baseline".format(result["name"]))
+            continue
+
+        change = result["throughput"] / \
+            previous[result["name"]]["throughput"] - 1
+        msg = "{}: {:.1f} -> {:.1f} audio-hours/hour ({:+.1f}%)".format(
+            result["name"], previous[result["name"]]["throughput"], result["throughput"], change * 100)
+        if change < -tolerance:
+            mkabook.fail_msg(msg)
+            regressions += 1
+        else:
+            mkabook.good_msg(msg)
+
+    return regressions
+
+
+################################################################################
+#  Main                                                                        #
+################################################################################
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark mkabook against a synthetic library: {}".format(mkabook.VERSION))
+
+    parser.add_argument("--work-dir", type=str, default=os.path.join(tempfile.gettempdir(), "mkabook-bench"),
+                        help="Where to generate the synthetic library, it is reused between runs with the same parameters")
+    parser.add_argument("--books", type=int, default=4,
+                        help="Number of books in the library")
+    parser.add_argument("--files", type=int, default=3,
+                        help="Number of input files per book")
+    parser.add_argument("--duration", type=float, default=600,
+                        help="Duration of every input file in seconds")
+    parser.add_argument("--source", choices=["sine", "noise"], default="noise",
+                        help="Signal used for the generated audio, noise is harder to encode")
+    parser.add_argument("--input-codec", choices=sorted(INPUT_FORMATS), default="mp3",
+                        help="Codec of the generated input files")
+    parser.add_argument("--channels", type=int, default=1,
+                        help="Channels of the generated input files")
+    parser.add_argument("--codecs", type=lambda x: x.split(","), default=["copy", "aac", "flac", "mp3"],
+                        help="Comma separated output codecs to benchmark")
+    parser.add_argument("--jobs", type=lambda x: [int(j) for j in x.split(",")], default=[1, mkabook.available_cores()],
+                        help="Comma separated batch job counts to benchmark")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Run every case this many times and keep the fastest")
+    parser.add_argument("--save-baseline", type=str,
+                        help="Store the results in this file")
+    parser.add_argument("--baseline", type=str,
+                        help="Compare the results with a previously stored baseline")
+    parser.add_argument("--tolerance", type=float, default=10,
+                        help="Percent of throughput lost compared to the baseline before a case counts as a regression")
+
+    opts = parser.parse_args()
+    opts.jobs = sorted(set(opts.jobs))
+    return opts
+
+
+def main():
+    opts = parse_args()
+
+    library = os.path.join(opts.work_dir, "library")
+    generate_library(library, opts.books, opts.files, opts.duration,
+                     opts.source, opts.input_codec, opts.channels)
+
+    results = best_results(run_benchmarks(opts, library))
+
+    report = {
+        "version": mkabook.VERSION,
+        "time": time.time(),
+        "cores": mkabook.available_cores(),
+        "library": {
+            "books": opts.books,
+            "files": opts.files,
+            "duration": opts.duration,
+            "source": opts.source,
+            "input_codec": opts.input_codec,
+            "channels": opts.channels,
+        },
+        "results": results,
+    }
+
+    if opts.save_baseline:
+        with open(opts.save_baseline, "w") as f:
+            json.dump(report, f, indent=4)
+        mkabook.good_msg("Saved baseline to {}".format(opts.save_baseline))
+
+    if opts.baseline:
+        with open(opts.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["library"] != report["library"]:
+            mkabook.warn_msg(
+                "Baseline was measured on a different library, results may not be comparable")
+        if compare_baseline(results, baseline, opts.tolerance / 100) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,8 +9,22 @@ import json
 import sys
 import tempfile
 import time
-import multiprocessing
 import shutil
+import math
+import hashlib
+import sqlite3
+import asyncio
+import threading
+import collections
+import re
+import contextlib
+import xml.sax.saxutils
+import ctypes
+import ctypes.util
+import struct
+import signal
+import socket
+import weakref
 
 VERSION = "v0.2.0"
 
@@ -18,20 +32,182 @@ DEFAULTS = {
     "input_files": None,
     "codec": "libfdk_aac",
     "bitrate": None,
+    "quality": None,
+    "channels": None,
+    "sample_rate": None,
+    "profile": None,
+    "auto_codec": "libfdk_aac",
     "cover_file": None,
+    "cover_max_size": None,
+    "cover_quality": 3,
     "chapter_file": None,
+    "tag_file": None,
     "convert_text_chapters": True,
     "use_sub_chapters": False,
     "output_file": None,
+    "single_pass": True,
+    "auto_chapters": True,
+    "encode_jobs": 1,
+    "threads": None,
+    "segment_cache": False,
+    "cache_dir": None,
+    "cache_size": "10G",
+    "scratch_dir": None,
+    "normalize": False,
+    "target_loudness": -23.0,
+    "gain": None,
+    "targets": None,
 }
 
+# Settings an output target may set, besides "output" naming its directory
+TARGET_OPTIONS = ["codec", "profile", "auto_codec", "bitrate", "quality",
+                  "channels", "sample_rate", "normalize", "target_loudness", "gain"]
+
+# Codecs "--codec auto" will copy into the output unchanged
+COPY_CODECS = ["aac", "flac", "mp3", "opus", "vorbis", "alac"]
+
 AUDIO_EXTENSION = [
     ".mka", ".m4a", ".m4b", ".flac", ".ogg", ".mp3"
 ]
 
+# Inputs mkvmerge appends to each other without ffmpeg, copying the audio
+APPEND_EXTENSIONS = [".mka", ".ogg", ".flac"]
+
 COVER_SEARCH_ITEMS = ["cover.jpg", "cover.jpeg", "cover.png"]
 CHAPTERS_SEARCH_ITEMS = ["chapters.xml",
                          "chapter.xml", "chapters.txt", "chapter.txt"]
+TAGS_SEARCH_ITEMS = ["tags.json", "tags.xml"]
+
+# Named sets of encoding settings, values set in config.json or on the command
+# line take precedence over the profile's
+PROFILES = {
+    # Mono narration at a size suited to streaming
+    "speech-low": {"bitrate": "32k", "channels": 1, "sample_rate": 22050},
+    # Mono narration close to transparent
+    "speech-hq": {"bitrate": "64k", "channels": 1, "sample_rate": 44100},
+    # Lossless, keeping the input format
+    "archive": {"codec": "flac"},
+}
+
+# Highest true peak in dBTP loudness normalization may raise a book to
+MAX_TRUE_PEAK = -1.0
+
+# Codecs whose independently encoded pieces join back together sample exactly
+GAPLESS_CODECS = ["flac"]
+
+# Seconds after which a partial output nobody writes to is left over from a
+# crashed build on another host
+PARTIAL_TIMEOUT = 3600
+
+
+# Raised when an item can't be processed
+class MkabookError(Exception):
+    pass
+
+
+################################################################################
+#  Library Interface                                                           #
+################################################################################
+
+# mkabook can be imported and driven from a long running program. Options are
+# the command line options as keyword arguments, named like the attributes
+# argparse gives them (codec="aac", diff=True, encode_jobs=2, ...), plus
+# cpu_budget to limit the cores an item uses when running several at once.
+# When `events` is given nothing is printed, it is called with each message
+# instead (see Debug Messages). Failures, and options with invalid values,
+# raise MkabookError.
+#
+#     result = await mkabook.convert("input/Some Book", "output", codec="aac")
+#     print(result.output_file, result.elapsed)
+
+# Process a single book, returning its Converted, Updated, or Skipped result
+async def convert(input, output=".", events=None, metrics=None, **options):
+    args = make_args(input, output, options)
+    return await handle_single_async(args, output_args={
+        "prefix": None,
+        "verbose_output": False,
+        "dynamic_output": False,
+        "events": events,
+    }, metrics=metrics)
+
+
+# Process every book below a library directory, returning the (name, result)
+# of each. Books which failed have their exception as the result.
+async def convert_library(input, output=".", events=None, metrics=None, **options):
+    args = make_args(input, output, options)
+    args.batch = True
+
+    books = await index_library(input)
+    share_cores(args, len(books))
+    return await run_batch(args, books, metrics, events)
+
+
+# Split an existing book into pieces, `mode` is as for --split. Returns a
+# Split result listing the pieces.
+async def split(input, output=".", mode="chapters", events=None, **options):
+    args = make_args(input, output, options)
+    args.split = mode
+    return await split_book(args, {
+        "prefix": None,
+        "verbose_output": False,
+        "dynamic_output": False,
+        "events": events,
+    })
+
+
+# Arguments for a run, starting from the command line defaults. Options are
+# checked like their command line counterparts.
+def make_args(input, output, options):
+    parser = make_parser()
+    args = parser.parse_args([input, "-o", output])
+    args.cpu_budget = None
+
+    actions = {x.dest: x for x in parser._actions}
+    for (name, value) in options.items():
+        if not hasattr(args, name) or name == "INPUT_FILE_OR_DIR":
+            raise MkabookError("Unknown option: {}".format(name))
+        if name in actions and value is not None:
+            value = check_option(actions[name], value)
+        setattr(args, name, value)
+    return args
+
+
+# Check an option value given from Python, strings are parsed as they would
+# be on the command line
+def check_option(action, value):
+    def fail(reason):
+        raise MkabookError("Invalid value for option {}: {!r} ({})".format(
+            action.dest, value, reason))
+
+    def check(item):
+        if isinstance(item, str) and action.type is not None:
+            try:
+                item = action.type(item)
+            except (argparse.ArgumentTypeError, ValueError) as e:
+                fail(e)
+        elif action.type is int and (isinstance(item, bool) or not isinstance(item, int)):
+            fail("expected a whole number")
+        elif action.type is float and (isinstance(item, bool) or not isinstance(item, (int, float))):
+            fail("expected a number")
+        elif action.type is str and not isinstance(item, str):
+            fail("expected a string")
+        elif action.type is jobs_arg and (isinstance(item, bool) or not isinstance(item, int) or item < 1):
+            fail("expected a number of at least 1 or 'auto'")
+        elif action.type is target_arg and not isinstance(item, dict):
+            fail("expected a dict or 'key=value,...' settings")
+        if action.choices is not None and item not in action.choices:
+            fail("choose from {}".format(", ".join(action.choices)))
+        return item
+
+    if action.nargs == 0:
+        if not isinstance(value, bool):
+            fail("expected True or False")
+        return value
+    if isinstance(action, argparse._AppendAction):
+        if not isinstance(value, (list, tuple)):
+            fail("expected a list")
+        return [check(x) for x in value]
+    return check(value)
 
 
 ################################################################################
@@ -44,23 +220,300 @@ def handle_single(args, output_args={
     "prefix": None,
     "verbose_output": False,
     "dynamic_output": True,
-}):
-    # Copy in the default configs
-    config = DEFAULTS.copy()
+}, metrics=None):
+    return asyncio.run(handle_single_async(args, output_args, metrics))
 
+
+# Process one item, timing it and every stage of it. Stage metrics are
+# written to `metrics` when it is given.
+async def handle_single_async(args, output_args={
+    "prefix": None,
+    "verbose_output": False,
+    "dynamic_output": True,
+}, metrics=None):
+    name = os.path.basename(os.path.abspath(args.INPUT_FILE_OR_DIR))
+    if getattr(args, "book_index", None) is not None:
+        name = args.book_index.name
+    book_metrics = BookMetrics(metrics, name)
+    output_args = dict(output_args, metrics=book_metrics)
+
+    try:
+        result = await process_single(args, output_args)
+    except Exception as e:
+        book_metrics.finish(e)
+        raise
+
+    book_metrics.finish(result)
+    result.elapsed = book_metrics.elapsed
+    result.audio_duration = book_metrics.audio_duration
+    return result
+
+
+async def process_single(args, output_args):
     # THe working directory is where we will search for all our input
     # The user may have specified a single file, so just use its location as
     # working directory
     work_dir = args.INPUT_FILE_OR_DIR
     if not os.path.isdir(args.INPUT_FILE_OR_DIR):
         work_dir = os.path.dirname(args.INPUT_FILE_OR_DIR)
-        # Set this as the only input file
-        config["input_files"] = [args.INPUT_FILE_OR_DIR]
 
     work_dir = os.path.abspath(work_dir)
 
+    # Everything below is looked up in one scan of the directory, batch runs
+    # pass in the index built while walking the library
+    index = getattr(args, "book_index", None)
+    if index is None:
+        index = BookIndex(work_dir)
+
+    # The manifest lets --diff skip unchanged books from a few stat calls,
+    # before any configuration is loaded or inputs are searched for
+    # Targets given on the command line have manifests of their own
+    book_key = os.path.abspath(args.INPUT_FILE_OR_DIR)
+    manifest = open_manifest(args, output_args) if not args.target else None
+    status = None
+    if manifest is not None:
+        signature = book_signature(args.INPUT_FILE_OR_DIR, index)
+        options = manifest_options(args)
+        status = manifest.status(book_key, signature, options)
+
+        if (args.diff or args.update_metadata) and status == Manifest.UP_TO_DATE:
+            good_msg("No action required", **output_args)
+            result = Skipped()
+            result.output_file = manifest.lookup(book_key)[0]
+            manifest.close()
+            return result
+        elif args.diff and status == Manifest.STALE:
+            good_msg("Inputs changed since the last build", **output_args)
+        elif (args.diff or args.update_metadata) and status == Manifest.METADATA_STALE:
+            good_msg("Meta-data changed since the last build", **output_args)
+
+    config = load_config(args, work_dir, index, output_args)
+
+    if len(config["input_files"]) == 0:
+        fail_msg("Could not find any input audio files", **output_args)
+        raise MkabookError("Could not find any input audio files")
+    elif len(config["input_files"]) == 1:
+        good_msg("Input Audio: {}".format(
+            config["input_files"][0]), **output_args)
+    else:
+        good_msg(
+            "Merging Input Audio: {}".format(config["input_files"]), **output_args)
+
+    # Books with several targets are built into each of their directories
+    if config["targets"]:
+        if manifest is not None:
+            manifest.close()
+        find_metadata(work_dir, index, config, output_args)
+        return await process_targets(args, work_dir, index, config, output_args)
+
+    good_msg("Output to: {}".format(config["output_file"]), **output_args)
+
+    # Check if the output already exists and the user only wants us handling
+    # New files, then return that we skipped this item
+    action = book_action(args, status, config["output_file"])
+    if action == "skip":
+        # Outputs built before the manifest existed are taken as up to date
+        if manifest is not None:
+            manifest.record(book_key, signature, options,
+                            config, config["output_file"])
+            manifest.close()
+        good_msg("No action required", **output_args)
+        result = Skipped()
+        result.output_file = config["output_file"]
+        return result
+
+    find_metadata(work_dir, index, config, output_args)
+
+    # Processing rewrites some entries, keep what the book was built from
+    effective_config = config.copy()
+
+    # An interrupted build leaves this entry behind so --diff won't trust
+    # whatever partial output exists
+    if manifest is not None:
+        manifest.begin(book_key, config["output_file"])
+
+    if action == "update":
+        result = await process_update(work_dir, config, output_args)
+    else:
+        start = time.monotonic()
+        result = await process_conversion(work_dir, config, output_args)
+        # Cached segments would make the encoder look faster than it is
+        if manifest is not None and isinstance(result, Converted) and not config["segment_cache"]:
+            manifest.record_build(config["codec"], await probe_total_duration(config["input_files"], config),
+                                  time.monotonic() - start, config["output_file"])
+
+    if manifest is not None:
+        manifest.record(book_key, signature, options,
+                        effective_config, config["output_file"])
+        manifest.close()
+
+    result.output_file = config["output_file"]
+    return result
+
+
+# Build a book into every one of its targets. Each target keeps its own
+# manifest, so --diff only skips the targets which are up to date, and every
+# target that needs its audio built is encoded from the same decode.
+async def process_targets(args, work_dir, index, config, output_args):
+    targets = target_states(args, index, config, output_args, create=True)
+
+    for (target, _, _, status, action) in targets:
+        good_msg("Output to: {} ({})".format(target["output_file"], action if status is None else "{}, {}".format(
+            action, status)), **output_args)
+
+    book_key = os.path.abspath(args.INPUT_FILE_OR_DIR)
+    signature = book_signature(args.INPUT_FILE_OR_DIR, index)
+    effective_configs = [x[0].copy() for x in targets]
+    for (target, manifest, _, _, action) in targets:
+        if manifest is not None and action != "skip":
+            manifest.begin(book_key, target["output_file"])
+
+    results = {}
+    try:
+        for (idx, (target, _, _, _, action)) in enumerate(targets):
+            if action == "skip":
+                results[idx] = Skipped()
+            elif action == "update":
+                results[idx] = await process_update(work_dir, target, output_args)
+
+        converting = [idx for (idx, x) in enumerate(targets)
+                      if x[4] == "convert"]
+        if converting:
+            converted = await process_conversion(work_dir, config, output_args,
+                                                 [targets[x][0] for x in converting])
+            results.update(zip(converting, converted))
+
+        for (idx, (target, manifest, options, _, _)) in enumerate(targets):
+            if manifest is not None:
+                manifest.record(book_key, signature, options,
+                                effective_configs[idx], target["output_file"])
+    finally:
+        for (_, manifest, _, _, _) in targets:
+            if manifest is not None:
+                manifest.close()
+
+    result = Targets([(x[0]["output_file"], results[idx])
+                      for (idx, x) in enumerate(targets)])
+    result.output_file = targets[0][0]["output_file"]
+    return result
+
+
+# The configuration of every target of a book, with its manifest, the options
+# recorded in the manifest, its manifest status, and the action it needs
+def target_states(args, index, config, output_args, create=False):
+    book_key = os.path.abspath(args.INPUT_FILE_OR_DIR)
+    signature = book_signature(args.INPUT_FILE_OR_DIR, index)
+
+    states = []
+    outputs = set()
+    for spec in config["targets"]:
+        target = target_config(args, index, config, spec)
+        # Targets writing the same file would replace each other's output
+        output_file = os.path.abspath(target["output_file"])
+        if output_file in outputs:
+            raise MkabookError(
+                "Several targets write to {}, give each one its own output".format(output_file))
+        outputs.add(output_file)
+
+        output_dir = os.path.dirname(target["output_file"])
+        if create:
+            os.makedirs(output_dir, exist_ok=True)
+
+        manifest = open_manifest(args, output_args, output_dir)
+        options = dict(manifest_options(args), target=spec)
+        status = None
+        if manifest is not None:
+            status = manifest.status(book_key, signature, options)
+        states.append((target, manifest, options, status,
+                       book_action(args, status, target["output_file"])))
+
+    return states
+
+
+# The configuration of one target of a book. A target's profile replaces the
+# encoding settings of the book, and its own settings replace the profile's.
+# Relative target directories are below the output directory.
+def target_config(args, index, config, spec):
+    target = config.copy()
+    target["targets"] = None
+
+    if spec.get("profile") is not None:
+        if spec["profile"] not in PROFILES:
+            raise MkabookError("Unknown profile: {}".format(spec["profile"]))
+        target.update(PROFILES[spec["profile"]])
+    for (key, value) in spec.items():
+        if key in TARGET_OPTIONS:
+            target[key] = value
+        elif key != "output":
+            raise MkabookError("Unknown target setting: {}".format(key))
+
+    output_dir = os.path.join(output_directory(args), spec.get("output", "."))
+    target["output_file"] = os.path.join(output_dir, index.name + ".mka")
+    return target
+
+
+# Try to locate the cover, chapters, and tags of a book not set by its
+# configuration
+def find_metadata(work_dir, index, config, output_args):
+    # Try to locate a cover file
+    if not config["cover_file"]:
+        search_item = index.find(COVER_SEARCH_ITEMS)
+        if search_item is not None:
+            config["cover_file"] = os.path.join(work_dir, search_item)
+            good_msg(
+                "Using cover: {}".format(config["cover_file"]), **output_args)
+        else:
+            warn_msg("No cover found", **output_args)
+
+    # Try to locate a chapter definition file
+    if not config["chapter_file"]:
+        config["chapter_file"] = index.find(CHAPTERS_SEARCH_ITEMS)
+        if config["chapter_file"] is not None:
+            good_msg(
+                "Using chapters: {}".format(config["chapter_file"]), **output_args)
+        else:
+            warn_msg("No chapter info found", **output_args)
+
+    # Try to locate a tag file
+    if not config["tag_file"]:
+        config["tag_file"] = index.find(TAGS_SEARCH_ITEMS)
+        if config["tag_file"] is not None:
+            good_msg(
+                "Using tags: {}".format(config["tag_file"]), **output_args)
+
+
+# What processing an item with an existing output in the state `status` does,
+# "skip", "update" (only its meta-data), or "convert"
+def book_action(args, status, output_file):
+    if (args.diff or args.update_metadata) and status == Manifest.UP_TO_DATE:
+        return "skip"
+
+    exists = os.path.exists(output_file)
+    if args.diff and exists and not args.update_metadata and status not in [Manifest.STALE, Manifest.METADATA_STALE]:
+        return "skip"
+
+    # Only the audio needs converting, changed meta-data is written into the
+    # headers of the existing output
+    if exists and (args.update_metadata or (args.diff and status == Manifest.METADATA_STALE)):
+        if not (args.diff and status == Manifest.STALE):
+            return "update"
+
+    return "convert"
+
+
+# Assemble the configuration of an item from the defaults, its config.json,
+# the profile, and the command line, in increasing precedence
+def load_config(args, work_dir, index, output_args):
+    # Copy in the default configs
+    config = DEFAULTS.copy()
+
+    # Set a single input file as the only input
+    if not os.path.isdir(args.INPUT_FILE_OR_DIR):
+        config["input_files"] = [os.path.abspath(args.INPUT_FILE_OR_DIR)]
+
     # Load up the config.json from this directory
-    if not args.ignore_cfg:
+    config_from_file = {}
+    if not args.ignore_cfg and "config.json" in index.files:
         try:
             with open(os.path.join(work_dir, "config.json"), 'r') as cfg_file:
                 try:
@@ -74,284 +527,1970 @@ def handle_single(args, output_args={
             pass
 
     # Command line items superceed even the config file
+    if args.profile is not None:
+        config["profile"] = args.profile
+    if config["profile"] is not None:
+        if config["profile"] not in PROFILES:
+            raise MkabookError("Unknown profile: {}".format(config["profile"]))
+        for (key, value) in PROFILES[config["profile"]].items():
+            if key not in config_from_file:
+                config[key] = value
     if args.codec is not None:
         config["codec"] = args.codec
     if args.cover is not None:
         config["cover_file"] = args.cover
     if args.chapters is not None:
         config["chapter_file"] = args.chapters
+    if args.tags is not None:
+        config["tag_file"] = args.tags
     config["use_sub_chapters"] = args.use_sub_chapters
+    if args.no_auto_chapters:
+        config["auto_chapters"] = False
+    if args.multi_pass:
+        config["single_pass"] = False
+    if args.encode_jobs is not None:
+        config["encode_jobs"] = args.encode_jobs
+    if args.scratch_dir is not None:
+        config["scratch_dir"] = args.scratch_dir
+    if args.normalize:
+        config["normalize"] = True
+    if args.target_loudness is not None:
+        config["target_loudness"] = args.target_loudness
+    if args.target:
+        config["targets"] = args.target
+    if args.cover_size is not None:
+        config["cover_max_size"] = args.cover_size
+    if args.cover_quality is not None:
+        config["cover_quality"] = args.cover_quality
+
+    # Share this item's part of the CPU between its ffmpeg processes
+    cpu_budget = getattr(args, "cpu_budget", None) or available_cores()
+    if config["encode_jobs"] == "auto":
+        config["encode_jobs"] = cpu_budget
+    config["threads"] = max(1, cpu_budget // config["encode_jobs"])
+    apply_cache_args(args, config)
 
     # Try to locate input files
     if not config["input_files"]:
-        config["input_files"] = []
-        for item in os.listdir(work_dir):
-            (_, ext) = os.path.splitext(item)
-
-            if ext in AUDIO_EXTENSION:
-                config["input_files"].append(os.path.join(work_dir, item))
-
-    if len(config["input_files"]) == 0:
-        fail_msg("Could not find any input audio files", **output_args)
-        raise Exception("Could not find any input audio files")
-    elif len(config["input_files"]) == 1:
-        good_msg("Input Audio: {}".format(
-            config["input_files"][0]), **output_args)
-    else:
-        good_msg(
-            "Merging Input Audio: {}".format(config["input_files"]), **output_args)
+        config["input_files"] = [os.path.join(work_dir, x)
+                                 for x in index.audio_files]
 
     # Set up the output file in our configuration
     if not config["output_file"]:
         if os.path.isfile(args.output):
             config["output_file"] = args.output
         else:
-            out_name = os.path.basename(work_dir) + ".mka"
+            out_name = index.name + ".mka"
             config["output_file"] = os.path.join(args.output, out_name)
 
-    good_msg("Output to: {}".format(config["output_file"]), **output_args)
+    return config
 
-    # Check if the output already exists and the user only wants us handling
-    # New files, then return that we skipped this item
-    if args.diff and (os.path.exists(config["output_file"]) and not args.update_metadata):
-        good_msg("No action required", **output_args)
-        return Skipped()
 
-    # Try to locate a cover file
-    if not config["cover_file"]:
-        for search_item in COVER_SEARCH_ITEMS:
-            if os.path.isfile(os.path.join(work_dir, search_item)):
-                config["cover_file"] = os.path.join(work_dir, search_item)
-                good_msg(
-                    "Using cover: {}".format(config["cover_file"]), **output_args)
-                break
+async def process_update(work_dir, config, output_args):
+    # Execute everything in a temporary directory
+    with tempfile.TemporaryDirectory(prefix="mkabook", dir=config["scratch_dir"]) as tmp_dir:
+        prepare_chapters(work_dir, tmp_dir, config, output_args)
+        prepare_tags(work_dir, tmp_dir, config, output_args)
+        await prepare_cover(tmp_dir, config, output_args)
+
+        if config["chapter_file"] is None and config["auto_chapters"] and len(config["input_files"]) > 1:
+            await generate_chapters(tmp_dir, config, output_args)
+
+        # Covers attached by an earlier build are replaced rather than added
+        attachments = await list_attachments(config["output_file"])
+        edit_options = metadata_options(config, attachments)
+
+        if not edit_options:
+            return Skipped()
+
+        # mkvpropedit rewrites the header elements in place, the audio
+        # clusters are never touched
+        await run_process("Updating MKV Meta-data", ["mkvpropedit", config["output_file"]] + edit_options,
+                          **output_args)
+
+    return Updated(config["chapter_file"] is not None, config["cover_file"] is not None, config["tag_file"] is not None)
+
+
+# Build the book into a hidden file beside the output and rename it into place
+# once complete. The rename stays on one filesystem so it is atomic, and an
+# interrupted build never leaves a truncated output behind. With `targets`
+# the book is built into each of them instead, returning a result for each.
+async def process_conversion(work_dir, config, output_args, targets=None):
+    outputs = targets or [config]
+    output_files = [x["output_file"] for x in outputs]
+    for output in outputs:
+        remove_stale_partials(output["output_file"], output_args)
+        output["output_file"] = os.path.join(os.path.dirname(output["output_file"]),
+                                             ".{}.{}-{}.partial".format(os.path.basename(output["output_file"]), socket.gethostname(), os.getpid()))
+    try:
+        # Exectute everything within the context of the Temporary directory
+        with tempfile.TemporaryDirectory(prefix="mkabook", dir=config["scratch_dir"]) as tmp_dir:
+            if targets:
+                result = await build_targets(work_dir, tmp_dir, config, targets, output_args)
+            else:
+                result = await build_book(work_dir, tmp_dir, config, output_args)
+        for (output, output_file) in zip(outputs, output_files):
+            os.replace(output["output_file"], output_file)
+    finally:
+        for (output, output_file) in zip(outputs, output_files):
+            if os.path.exists(output["output_file"]):
+                os.remove(output["output_file"])
+            output["output_file"] = output_file
+
+    return result
+
+
+# Remove the partial outputs of a book left behind by builds that crashed:
+# those of a process no longer running on this host, and any nothing has
+# written to for PARTIAL_TIMEOUT seconds
+def remove_stale_partials(output_file, output_args):
+    directory = os.path.dirname(output_file)
+    prefix = ".{}.".format(os.path.basename(output_file))
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+
+    for name in names:
+        if not (name.startswith(prefix) and name.endswith(".partial")):
+            continue
+        (host, _, pid) = name[len(prefix):-len(".partial")].rpartition("-")
+        path = os.path.join(directory, name)
+        try:
+            crashed = host == socket.gethostname() and pid.isdigit() and not pid_running(int(pid))
+            if not crashed and time.time() - os.stat(path).st_mtime < PARTIAL_TIMEOUT:
+                continue
+            os.remove(path)
+            warn_msg("Removed the partial output of an interrupted build: {}".format(path), **output_args)
+        except OSError:
+            pass
+
+
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+async def build_book(work_dir, tmp_dir, config, output_args):
+    # Check if the chapters need conversion and create a temp xml file
+    prepare_chapters(work_dir, tmp_dir, config, output_args)
+    prepare_tags(work_dir, tmp_dir, config, output_args)
+    await prepare_cover(tmp_dir, config, output_args)
+
+    if config["normalize"]:
+        await normalize_loudness(config, output_args)
+
+    if config["codec"] == "auto":
+        await choose_codec(config, output_args)
+
+    if (config["channels"] or config["sample_rate"]) and config["codec"] != "copy":
+        await match_input_format(config, output_args)
+
+    if config["codec"] == "copy" and all([os.path.splitext(x)[1].lower() in APPEND_EXTENSIONS for x in config["input_files"]]):
+        return await process_append(config, output_args)
+
+    # Without chapters a merged book at least gets one per input file
+    if config["chapter_file"] is None and config["auto_chapters"] and len(config["input_files"]) > 1:
+        await generate_chapters(tmp_dir, config, output_args)
+
+    if (config["encode_jobs"] > 1 or config["segment_cache"]) and config["codec"] != "copy":
+        if config["codec"] in GAPLESS_CODECS:
+            return await process_segmented(tmp_dir, config, output_args)
+        # Lossy encoders pad every piece they encode, joining the pieces
+        # would leave short gaps at every boundary
+        warn_msg("Can't encode {} in segments without gaps, encoding in a single pass".format(
+            config["codec"]), **output_args)
+
+    if config["single_pass"]:
+        return await process_single_pass(tmp_dir, config, output_args)
+
+    if len(config["input_files"]) > 1:
+        # Merge files
+        write_concat_list(os.path.join(tmp_dir, "concat.txt"),
+                          sorted(config["input_files"], key=natural_key))
+
+        # p = subprocess.Popen(["ffmpeg", "-f", "concat", "-safe", "0", "-i", os.path.join(
+        #     tmp_dir, "concat.txt"), "-c", "copy", os.path.join(tmp_dir, "concat.mka")], **REDIRECT_ARGS)
+        # poll_message(p, prefix + "Merging audio tracks")
+        await run_process("Merging audio tracks", ["ffmpeg", "-f", "concat", "-safe", "0", "-i", os.path.join(
+            tmp_dir, "concat.txt"), "-c", "copy", os.path.join(tmp_dir, "concat.mka")], **output_args)
+
+        config["input_file"] = os.path.join(tmp_dir, "concat.mka")
+    else:
+        config["input_file"] = config["input_files"][0]
+
+    # p = subprocess.Popen(["ffmpeg", "-i", config["input_file"], "-acodec",
+    #                       config["codec"], os.path.join(tmp_dir, "converted.mka")], **REDIRECT_ARGS)
+    # poll_message(p, prefix + "Converting Audio")
+
+    await run_process("Converting Audio", ["ffmpeg"] + thread_options(config) + ["-i", config["input_file"]] +
+                      encode_options(config) + thread_options(config) + [os.path.join(tmp_dir, "converted.mka")], **output_args)
+
+    merge_options = ["mkvmerge", "-o", config["output_file"]]
+
+    if config["chapter_file"]:
+        merge_options += ["--chapters", config["chapter_file"]]
+
+    if config["tag_file"]:
+        merge_options += ["--global-tags", config["tag_file"]]
+
+    if config["cover_file"]:
+        merge_options += ["--attachment-description",
+                          "Cover", "--attach-file", config["cover_file"]]
+
+    # Input is our temp file
+    merge_options += [os.path.join(tmp_dir, "converted.mka")]
+
+    # p = subprocess.Popen(
+    #     merge_options, **REDIRECT_ARGS)
+
+    # poll_message(p, prefix + "Merging MKV Meta-data")
+    await run_process("Merging MKV Meta-data", merge_options,
+                      **output_args)
+
+    return Converted(config["codec"], config["chapter_file"] is not None, config["cover_file"] is not None, config["tag_file"] is not None)
+
+
+# Copy the audio of inputs mkvmerge can read natively straight into the
+# output, appending them to each other in one remux. No temporary audio is
+# written, the inputs are read once in order and the output written once.
+# Without a chapters file mkvmerge marks a chapter where each input starts,
+# named after its file.
+async def process_append(config, output_args):
+    merge_options = ["mkvmerge", "-o", config["output_file"]]
+
+    if config["chapter_file"]:
+        merge_options += ["--chapters", config["chapter_file"]]
+    elif config["auto_chapters"] and len(config["input_files"]) > 1:
+        merge_options += ["--generate-chapters", "when-appending",
+                          "--generate-chapters-name-template", "<FILE_NAME>"]
+
+    if config["tag_file"]:
+        merge_options += ["--global-tags", config["tag_file"]]
+
+    if config["cover_file"]:
+        merge_options += ["--attachment-description",
+                          "Cover", "--attach-file", config["cover_file"]]
+
+    # Only the audio of the inputs is kept, chapters of merged inputs would
+    # overlap the book's
+    for (idx, input) in enumerate(sorted(config["input_files"], key=natural_key)):
+        if idx > 0:
+            merge_options += ["+"]
+        merge_options += ["--no-video", "--no-subtitles", "--no-attachments"]
+        if len(config["input_files"]) > 1:
+            merge_options += ["--no-chapters"]
+        merge_options += [input]
+
+    await run_process("Appending audio", merge_options, **output_args)
+
+    return Converted(config["codec"], config["chapter_file"] is not None or "--generate-chapters" in merge_options,
+                     config["cover_file"] is not None, config["tag_file"] is not None)
+
+
+# Encode the book into several targets with a single ffmpeg process. The
+# inputs are read and decoded once and the decoded audio is fed to the
+# encoder of every target. Targets are always built in one streaming pass.
+async def build_targets(work_dir, tmp_dir, config, targets, output_args):
+    prepare_chapters(work_dir, tmp_dir, config, output_args)
+    prepare_tags(work_dir, tmp_dir, config, output_args)
+    await prepare_cover(tmp_dir, config, output_args)
+
+    if config["chapter_file"] is None and config["auto_chapters"] and len(config["input_files"]) > 1:
+        await generate_chapters(tmp_dir, config, output_args)
+
+    for target in targets:
+        for key in ["chapter_file", "tag_file", "cover_file"]:
+            target[key] = config[key]
+
+        # Loudness measurements are cached, only the first target measures
+        if target["normalize"]:
+            await normalize_loudness(target, output_args)
+        if target["codec"] == "auto":
+            await choose_codec(target, output_args)
+        if (target["channels"] or target["sample_rate"]) and target["codec"] != "copy":
+            await match_input_format(target, output_args)
+
+    if len(config["input_files"]) > 1:
+        concat_file = os.path.join(tmp_dir, "concat.txt")
+        write_concat_list(concat_file, sorted(config["input_files"], key=natural_key))
+        input_options = ["-f", "concat", "-safe", "0", "-i", concat_file]
+    else:
+        input_options = ["-i", config["input_files"][0]]
+
+    with measure_stage(output_args, "Probing inputs"):
+        duration = await probe_total_duration(config["input_files"], config)
+    await write_outputs("Converting audio for {} target(s)".format(len(targets)), input_options,
+                        [(encode_options(x), x) for x in targets], duration, config, output_args)
+
+    return [Converted(x["codec"], x["chapter_file"] is not None, x["cover_file"] is not None, x["tag_file"] is not None)
+            for x in targets]
+
+
+# Concatenate, encode and mux the book in one streaming ffmpeg pass directly
+# into the output file. Chapters and the cover are then applied by editing the
+# Matroska headers in place, so no full size copy of the audio is ever written
+# to the temporary directory.
+async def process_single_pass(tmp_dir, config, output_args):
+    if len(config["input_files"]) > 1:
+        concat_file = os.path.join(tmp_dir, "concat.txt")
+        write_concat_list(concat_file, sorted(config["input_files"], key=natural_key))
+        input_options = ["-f", "concat", "-safe", "0", "-i", concat_file]
+        msg = "Merging and converting audio"
+    else:
+        input_options = ["-i", config["input_files"][0]]
+        msg = "Converting Audio"
+
+    with measure_stage(output_args, "Probing inputs"):
+        duration = await probe_total_duration(config["input_files"], config)
+    await write_output(msg, input_options, encode_options(config), duration, config, output_args)
+
+    return Converted(config["codec"], config["chapter_file"] is not None, config["cover_file"] is not None, config["tag_file"] is not None)
+
+
+# Encode the pieces of a book concurrently and then stream-copy them together.
+# Pieces follow the input file boundaries, a single input is cut into time
+# slices. Only gapless codecs can be joined this way without adding samples.
+# Pieces found in the segment cache are reused instead of encoded.
+async def process_segmented(tmp_dir, config, output_args):
+    jobs = config["encode_jobs"]
+    with measure_stage(output_args, "Probing inputs"):
+        segments = await plan_segments(config)
+
+    cache = None
+    if config["segment_cache"]:
+        cache = open_cache(config)
+    elif len(segments) < 2:
+        return await process_single_pass(tmp_dir, config, output_args)
+
+    seg_files = []
+    to_encode = []
+    for (idx, (source, seek_options, _)) in enumerate(segments):
+        seg_file = os.path.join(tmp_dir, "segment{:05}.mka".format(idx))
+        key = None
+        if cache is not None:
+            # Hashing can take a while, keep the event loop responsive
+            with measure_stage(output_args, "Fingerprinting inputs"):
+                digest = await asyncio.to_thread(cache.fingerprint, source)
+            key = cache.segment_key(
+                digest, seek_options + encode_options(config))
+            cached = cache.lookup_segment(key, seg_file)
+            if cached is not None:
+                seg_files.append(cached)
+                continue
+
+        seg_files.append(seg_file)
+        # -ss has to come before the input to seek, -t after it to limit
+        input_options = seek_options[:2] + \
+            ["-i", source] + seek_options[2:]
+        to_encode.append((idx, input_options, seg_file, key))
+
+    if cache is not None:
+        good_msg("Reusing {} of {} cached segments".format(
+            len(segments) - len(to_encode), len(segments)), **output_args)
+
+    if len(to_encode) > 0:
+        good_msg("Encoding {} segments with {} jobs".format(
+            len(to_encode), jobs), **output_args)
+
+    seg_output_args = output_args.copy()
+    seg_output_args["dynamic_output"] = False
+    limit = asyncio.Semaphore(jobs)
+
+    async def encode(idx, input_options, seg_file):
+        async with limit:
+            await run_process("Encoding segment {}/{}".format(idx + 1, len(segments)),
+                              ["ffmpeg", "-nostdin", "-y"] + thread_options(config) + input_options + ["-map", "0:a"] + encode_options(config) + thread_options(config) + ["-f", "matroska", seg_file], duration=segments[idx][2], stage="Encoding segment", **seg_output_args)
+
+    await run_all([encode(idx, input_options, seg_file)
+                   for (idx, input_options, seg_file, _) in to_encode])
+
+    if cache is not None:
+        for (_, _, seg_file, key) in to_encode:
+            cache.store_segment(key, seg_file)
+        cache.evict(config["cache_size"])
+        cache.close()
+
+    concat_file = os.path.join(tmp_dir, "segments.txt")
+    write_concat_list(concat_file, seg_files)
+    await write_output("Joining encoded segments", [
+        "-f", "concat", "-safe", "0", "-i", concat_file], ["-acodec", "copy"], sum([x[2] or 0 for x in segments]) or None, config, output_args)
+
+    return Converted(config["codec"], config["chapter_file"] is not None, config["cover_file"] is not None, config["tag_file"] is not None)
+
+
+# Split a book into pieces which can be encoded independently, each is
+# (source, seek options, duration)
+async def plan_segments(config):
+    jobs = config["encode_jobs"]
+    sorted_input = sorted(config["input_files"], key=natural_key)
+
+    segments = []
+    if len(sorted_input) == 1 and jobs > 1:
+        # Whole seconds keep the slice boundaries sample exact at any rate
+        duration = (await probe_files(sorted_input, config))[0]["duration"]
+        slice_len = max(1, int(math.ceil(duration / jobs)))
+        start = 0
+        while start < duration:
+            segments.append((sorted_input[0], ["-ss", str(start), "-t", str(slice_len)],
+                             min(slice_len, duration - start)))
+            start += slice_len
+    else:
+        infos = await probe_files(sorted_input, config)
+        for (input, info) in zip(sorted_input, infos):
+            segments.append((input, [], info["duration"]))
+
+    return segments
+
+
+# The ffmpeg options which control how the audio is encoded
+def encode_options(config):
+    options = ["-acodec", config["codec"]]
+    if config["codec"] == "copy":
+        return options
+
+    if config["bitrate"]:
+        options += ["-b:a", str(config["bitrate"])]
+    if config["quality"] is not None:
+        # libfdk_aac calls its VBR modes by another name
+        if config["codec"] == "libfdk_aac":
+            options += ["-vbr", str(config["quality"])]
         else:
-            warn_msg("No cover found", **output_args)
+            options += ["-q:a", str(config["quality"])]
+    if config["channels"]:
+        options += ["-ac", str(config["channels"])]
+    if config["sample_rate"]:
+        options += ["-ar", str(config["sample_rate"])]
+    if config["gain"]:
+        options += ["-af", "volume={:.2f}dB".format(config["gain"])]
+    return options
+
+
+# Work out the gain bringing the book to the target loudness. Every input is
+# measured once and the measurement kept with its probe data, so rebuilding
+# a book doesn't decode unchanged inputs just to measure them again.
+async def normalize_loudness(config, output_args):
+    if config["codec"] == "copy":
+        warn_msg("Can't normalize the loudness while copying the audio", **output_args)
+        return
+
+    with measure_stage(output_args, "Measuring loudness"):
+        infos = await probe_files(config["input_files"], config, loudness=True)
+
+    # The loudness of the whole book is the duration weighted average of the
+    # energy of its inputs
+    duration = sum([x["duration"] for x in infos])
+    energy = sum([x["duration"] * 10 ** (x["loudness"]["integrated"] / 10)
+                  for x in infos])
+    if duration <= 0 or energy <= 0:
+        warn_msg("The book is silent, not normalizing it", **output_args)
+        return
+    loudness = 10 * math.log10(energy / duration)
+
+    # Don't raise the peaks into clipping
+    peak = max([x["loudness"]["peak"] for x in infos])
+    config["gain"] = min(config["target_loudness"] - loudness,
+                         MAX_TRUE_PEAK - peak)
+
+    good_msg("Loudness {:.1f} LUFS, applying {:+.1f} dB of gain".format(
+        loudness, config["gain"]), **output_args)
+
+
+# Pick the codec for "--codec auto". Inputs sharing one codec, sample rate,
+# and channel layout are copied, since the concat demuxer can join them
+# without decoding. Otherwise, or when an input is above the configured
+# bitrate, the audio is transcoded with the "auto_codec".
+async def choose_codec(config, output_args):
+    try:
+        infos = await probe_files(config["input_files"], config)
+    except Exception as e:
+        warn_msg("Could not inspect the inputs: {}".format(e), **output_args)
+        infos = None
 
-    # Try to locate a chapter definition file
-    if not config["chapter_file"]:
-        for search_item in CHAPTERS_SEARCH_ITEMS:
-            if os.path.isfile(os.path.join(work_dir, search_item)):
-                config["chapter_file"] = search_item
-                good_msg(
-                    "Using chapters: {}".format(config["chapter_file"]), **output_args)
-                break
+    (config["codec"], reason) = decide_codec(config, infos)
+    if reason is None:
+        good_msg("Inputs are already {}, copying the audio".format(
+            infos[0]["codec"]), **output_args)
+    else:
+        good_msg("Converting to {}, {}".format(
+            config["codec"], reason), **output_args)
+
+
+# The codec "--codec auto" picks for inputs described by `infos`, and the
+# reason for converting them or None when they are copied
+def decide_codec(config, infos):
+    reason = None
+    if infos is None:
+        reason = "unknown input format"
+    elif len(set([(x["codec"], x["sample_rate"], x["channels"], x["channel_layout"]) for x in infos])) > 1:
+        reason = "inputs have mixed formats"
+    elif infos[0]["codec"] not in COPY_CODECS:
+        reason = "inputs are {}".format(infos[0]["codec"])
+    elif config["gain"] and abs(config["gain"]) >= 0.5:
+        reason = "normalizing the loudness"
+    elif config["bitrate"] and any([(x["bit_rate"] or 0) > parse_bitrate(config["bitrate"]) for x in infos]):
+        reason = "inputs exceed {}bps".format(config["bitrate"])
+    elif config["channels"] and infos[0]["channels"] > config["channels"]:
+        reason = "inputs have more than {} channels".format(config["channels"])
+    elif config["sample_rate"] and infos[0]["sample_rate"] > config["sample_rate"]:
+        reason = "inputs exceed {}Hz".format(config["sample_rate"])
+
+    if reason is None:
+        return ("copy", None)
+    return (config["auto_codec"], reason)
+
+
+# Only downmix or resample when it reduces the inputs to the configured
+# format, inputs already matching it (or below it) are left as they are
+async def match_input_format(config, output_args):
+    try:
+        infos = await probe_files(config["input_files"], config)
+    except Exception as e:
+        warn_msg("Could not inspect the inputs: {}".format(e), **output_args)
+        return
+
+    channels = set([x["channels"] for x in infos])
+    if len(channels) == 1 and config["channels"] and channels.pop() <= config["channels"]:
+        config["channels"] = None
+
+    sample_rates = set([x["sample_rate"] for x in infos])
+    if len(sample_rates) == 1 and config["sample_rate"] and sample_rates.pop() <= config["sample_rate"]:
+        config["sample_rate"] = None
+
+
+# Parse an ffmpeg style bitrate like "64k" into bits per second
+def parse_bitrate(bitrate):
+    if isinstance(bitrate, int):
+        return bitrate
+
+    UNITS = {"K": 1000, "M": 1000 ** 2}
+    bitrate = bitrate.strip().upper()
+    if bitrate and bitrate[-1] in UNITS:
+        return int(float(bitrate[:-1]) * UNITS[bitrate[-1]])
+    return int(bitrate)
+
+
+# Limit the decoder and encoder threads of an ffmpeg process to its share
+# of the cores. These go both before the input and before the output.
+def thread_options(config):
+    if config["threads"]:
+        return ["-threads", str(config["threads"])]
+    return []
+
+
+# Run the final ffmpeg pass into the output file and attach the metadata
+async def write_output(msg, input_options, output_options, duration, config, output_args):
+    await write_outputs(msg, input_options, [(output_options, config)], duration, config, output_args)
+
+
+# Run the final ffmpeg pass into several output files at once, `outputs` holds
+# the output options and configuration of each
+async def write_outputs(msg, input_options, outputs, duration, config, output_args):
+    output_options = []
+    for (options, output) in outputs:
+        output_options += ["-map", "0:a"] + options + thread_options(config) + \
+            ["-f", "matroska", output["output_file"]]
+    await run_process(msg, ["ffmpeg", "-nostdin", "-y"] + thread_options(config) + input_options +
+                      output_options, duration=duration, **output_args)
+
+    # mkvmerge cannot read from a pipe, but mkvpropedit only rewrites the
+    # header elements so the audio clusters are left where ffmpeg put them
+    for (_, output) in outputs:
+        edit_options = metadata_options(output, [])
+        if edit_options:
+            await run_process("Adding MKV Meta-data", ["mkvpropedit", output["output_file"]] + edit_options,
+                              **output_args)
+
+
+# mkvpropedit options writing the chapters, tags, and cover of a book. Covers
+# among the file's existing attachments are replaced.
+def metadata_options(config, attachments):
+    options = []
+
+    if config["chapter_file"]:
+        options += ["--chapters", config["chapter_file"]]
+
+    if config["tag_file"]:
+        options += ["--tags", "global:" + config["tag_file"]]
+
+    if config["cover_file"]:
+        covers = [x for x in attachments if x.get("description") == "Cover" or
+                  x.get("content_type", "").startswith("image/")]
+        options += ["--attachment-description", "Cover"]
+        if covers:
+            options += ["--replace-attachment",
+                        "={}:{}".format(covers[0]["properties"]["uid"], config["cover_file"])]
+            for cover in covers[1:]:
+                options += ["--delete-attachment",
+                            "={}".format(cover["properties"]["uid"])]
         else:
-            warn_msg("No chapter info found", **output_args)
+            options += ["--add-attachment", config["cover_file"]]
+
+    return options
 
-    if os.path.exists(config["output_file"]) and args.update_metadata:
-        return process_update(work_dir, config, output_args)
+
+# The attachments of a Matroska file as reported by mkvmerge
+async def list_attachments(path):
+    (returncode, output) = await capture_process(["mkvmerge", "-J", path])
+    try:
+        return json.loads(output).get("attachments", [])
+    except ValueError:
+        raise MkabookError("Could not read the attachments of: {}".format(path))
+
+
+# Convert QT style text chapters into a temporary Matroska XML file, or resolve
+# the path of an existing XML chapter file
+def prepare_chapters(work_dir, tmp_dir, config, output_args):
+    if config["chapter_file"] is None:
+        return
+
+    try:
+        if os.path.splitext(config["chapter_file"])[1] != ".xml":
+            chapters = Chapters(os.path.join(
+                work_dir, config["chapter_file"]))
+
+            with open(os.path.join(tmp_dir, "chapters.xml"), "w") as chap_file:
+                chapters.write(chap_file, config)
+            config["chapter_file"] = os.path.join(
+                tmp_dir, "chapters.xml")
+        else:
+            config["chapter_file"] = os.path.join(
+                work_dir, config["chapter_file"])
+    except Exception as e:
+        fail_msg("Failed to convert chapters file", **output_args)
+        raise MkabookError("Failed to convert chapter file")
     else:
-        return process_conversion(work_dir, config, output_args)
+        good_msg("Converted Chapters file", **output_args)
 
 
-def process_update(work_dir, config, output_args):
-    # Execute everything in a temporary directory
-    with tempfile.TemporaryDirectory(prefix="mkabook") as tmp_dir:
-        if config["chapter_file"] is not None:
-            try:
-                if os.path.splitext(config["chapter_file"])[1] != ".xml":
-                    chapters = Chapters(os.path.join(
-                        work_dir, config["chapter_file"]))
-
-                    with open(os.path.join(tmp_dir, "chapters.xml"), "w") as chap_file:
-                        chapters.write(chap_file, config)
-                    config["chapter_file"] = os.path.join(
-                        tmp_dir, "chapters.xml")
-                else:
-                    config["chapter_file"] = os.path.join(
-                        work_dir, config["chapter_file"])
-            except Exception as e:
-                fail_msg("Failed to convert chapters file", **output_args)
-                raise Exception("Failed to convert chapter file")
+# Shrink the cover to "cover_max_size" pixels on its longest side and
+# recompress it, when a maximum is configured. The processed cover is linked
+# into the temporary directory, so evicting it from the cache can't remove
+# it while the book is built. Covers which can't be processed are attached
+# unchanged.
+async def prepare_cover(tmp_dir, config, output_args):
+    if not config["cover_file"] or not config["cover_max_size"]:
+        return
+
+    try:
+        cached = await cover_workers().process(config["cover_file"], config, output_args)
+        cover_file = os.path.join(
+            tmp_dir, "cover" + os.path.splitext(cached)[1])
+        try:
+            os.link(cached, cover_file)
+        except OSError:
+            shutil.copyfile(cached, cover_file)
+        config["cover_file"] = cover_file
+    except Exception as e:
+        warn_msg("Could not process the cover, attaching it unchanged: {}".format(
+            e), **output_args)
+
+
+# Convert a JSON object of tag names and values into a temporary Matroska XML
+# tag file, or resolve the path of an existing XML tag file
+def prepare_tags(work_dir, tmp_dir, config, output_args):
+    if config["tag_file"] is None:
+        return
+
+    try:
+        if os.path.splitext(config["tag_file"])[1] != ".xml":
+            with open(os.path.join(work_dir, config["tag_file"]), "r") as tag_file:
+                tags = json.load(tag_file)
+
+            with open(os.path.join(tmp_dir, "tags.xml"), "w") as tag_file:
+                write_tags(tag_file, tags)
+            config["tag_file"] = os.path.join(tmp_dir, "tags.xml")
+        else:
+            config["tag_file"] = os.path.join(work_dir, config["tag_file"])
+    except Exception as e:
+        fail_msg("Failed to convert tags file", **output_args)
+        raise MkabookError("Failed to convert tag file")
+    else:
+        good_msg("Converted Tags file", **output_args)
+
+
+# Write tags applying to the whole book in the Matroska XML format
+def write_tags(file, tags):
+    file.write('<?xml version="1.0"?>\n<Tags>\n  <Tag>\n')
+    file.write(
+        '    <Targets>\n      <TargetTypeValue>50</TargetTypeValue>\n    </Targets>\n')
+    for (name, value) in sorted(tags.items()):
+        file.write("    <Simple>\n      <Name>{}</Name>\n      <String>{}</String>\n    </Simple>\n".format(
+            xml.sax.saxutils.escape(name.upper()), xml.sax.saxutils.escape(str(value))))
+    file.write("  </Tag>\n</Tags>\n")
+
+
+# Write a list of files for the ffmpeg concat demuxer, optionally limiting each
+# file to the range between 0 and its outpoint (in seconds)
+def write_concat_list(path, files):
+    with open(path, 'w') as c:
+        for input in files:
+            # Single quotes have to be closed, escaped, and re-opened
+            c.write("file '" + input.replace("'", "'\\''") + "'\n")
+
+
+# Total duration of several files, or None if any of them can't be probed
+async def probe_total_duration(paths, config, limit=None):
+    try:
+        return sum([x["duration"] for x in await probe_files(paths, config, limit=limit)])
+    except Exception:
+        return None
+
+
+# Create chapters at the start of every input file of a merged book, named
+# after the title tags of the files or otherwise their file names
+async def generate_chapters(tmp_dir, config, output_args):
+    sorted_input = sorted(config["input_files"], key=natural_key)
+    try:
+        infos = await probe_files(sorted_input, config)
+    except Exception as e:
+        warn_msg("Could not generate chapters: {}".format(e), **output_args)
+        return
+
+    titles = [x["title"] for x in infos]
+    # Files often all carry the title of the book
+    if None in titles or len(set(titles)) != len(titles):
+        titles = [os.path.splitext(os.path.basename(x))[0]
+                  for x in sorted_input]
+
+    chapters = Chapters()
+    start = 0.0
+    for (title, info) in zip(titles, infos):
+        chapters.chapters.append(Chapter(format_timestamp(start), title))
+        start += info["duration"]
+
+    with open(os.path.join(tmp_dir, "chapters.xml"), "w") as chap_file:
+        chapters.write(chap_file, config)
+    config["chapter_file"] = os.path.join(tmp_dir, "chapters.xml")
+
+    good_msg("Generated {} chapters from the input files".format(
+        len(titles)), **output_args)
+
+
+class ConversionResponse:
+    # Wall time spent on the item and the length of its audio, in seconds
+    elapsed = None
+    audio_duration = None
+    # Where the book is (or would have been) written
+    output_file = None
+
+    def timing(self):
+        if self.elapsed is None:
+            return ""
+
+        timing = "\n\tTime: {}".format(format_duration(self.elapsed))
+        if self.audio_duration:
+            timing += " ({:.1f}x realtime)".format(
+                self.audio_duration / max(self.elapsed, 0.001))
+        return timing
+
+
+class Converted(ConversionResponse):
+    def __init__(self, codec, has_chapters, has_cover, has_info):
+        self.codec = codec
+        self.has_chapters = has_chapters
+        self.has_cover = has_cover
+        self.has_info = has_info
+
+    def __str__(self):
+        return "Converted\n\tCodec: {}\n\tChapters: {}\n\tCover: {}\n\tTags: {}".format(self.codec, self.has_chapters, self.has_cover, self.has_info) + self.timing()
+
+
+class Skipped(ConversionResponse):
+    pass
+
+    def __str__(self):
+        return "Already exits, nothing to do"
+
+
+# The result of an item processed by another worker of a shared batch
+class Reported(ConversionResponse):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class Split(ConversionResponse):
+    def __init__(self, files):
+        self.files = files
+
+    def __str__(self):
+        return "Split into {} files".format(len(self.files)) + self.timing()
+
+
+# The results of a book built into several targets
+class Targets(ConversionResponse):
+    def __init__(self, results):
+        self.results = results
+
+    def __str__(self):
+        return "Built {} targets".format(len([x for x in self.results if not isinstance(x[1], Skipped)])) + \
+            "".join(["\n\t{}: {}".format(x[0], str(x[1]).split("\n")[0]) for x in self.results]) + self.timing()
+
+
+class Updated(ConversionResponse):
+    def __init__(self, has_chapters, has_cover, has_info):
+        self.has_chapters = has_chapters
+        self.has_cover = has_cover
+        self.has_info = has_info
+
+    def __str__(self):
+        return "Updated\n\tChapters: {}\n\tCover: {}\n\tTags: {}".format(self.has_chapters, self.has_cover, self.has_info) + self.timing()
+
+################################################################################
+#  Splitting                                                                   #
+################################################################################
+
+# Most pieces of a split book edited at once
+SPLIT_EDIT_JOBS = 8
+
+
+def handle_split(args):
+    result = asyncio.run(split_book(args, {
+        "prefix": None,
+        "verbose_output": args.v,
+        "dynamic_output": True,
+    }))
+    good_msg(result)
+
+
+# Cut a book into pieces with one sequential read by mkvmerge, copying the
+# audio. Every piece keeps the chapters within it and all attachments, and is
+# then titled after its chapter or part.
+async def split_book(args, output_args):
+    input = args.INPUT_FILE_OR_DIR
+    if not os.path.isfile(input):
+        raise MkabookError("Splitting expects an existing book file")
+
+    output_dir = output_directory(args)
+    name = os.path.splitext(os.path.basename(input))[0]
+    start_time = time.monotonic()
+
+    with tempfile.TemporaryDirectory(prefix="mkabook", dir=args.scratch_dir) as tmp_dir:
+        config = dict(DEFAULTS, use_sub_chapters=args.use_sub_chapters)
+
+        # Chapters from a separate file replace those of the book
+        if args.chapters is not None:
+            if os.path.splitext(args.chapters)[1] == ".xml":
+                raise MkabookError(
+                    "Splitting needs chapters from the book or a text chapters file")
+            config["chapter_file"] = os.path.abspath(args.chapters)
+            prepare_chapters(os.getcwd(), tmp_dir, config, output_args)
+            chapters = [(parse_timestamp(x.start), x.title)
+                        for x in Chapters(args.chapters).chapters]
+        else:
+            chapters = await read_chapters(input)
+
+        duration = (await probe_file(input))["duration"]
+        pieces = plan_split(args.split, chapters, duration)
+        if len(pieces) < 2:
+            raise MkabookError("Nothing to split, the book would stay in one piece")
+
+        # Keep all attachments, such as the cover, on every piece
+        attachments = await list_attachments(input)
+        split_options = ["mkvmerge", "-o", os.path.join(tmp_dir, "piece.mka"), "--split",
+                         "timestamps:" + ",".join(["{:.3f}s".format(x[0]) for x in pieces[1:]])]
+        if attachments:
+            split_options += ["--attachments",
+                              ",".join(["{}:all".format(x["id"]) for x in attachments])]
+        if config["chapter_file"]:
+            split_options += ["--chapters", config["chapter_file"]]
+        await run_process("Splitting into {} pieces".format(len(pieces)), split_options + [input],
+                          duration=duration, **output_args)
+
+        # mkvmerge numbers the pieces in order
+        files = sorted([os.path.join(tmp_dir, x) for x in os.listdir(tmp_dir) if x.startswith("piece-")],
+                       key=natural_key)
+        if len(files) != len(pieces):
+            raise MkabookError(
+                "Expected {} pieces but mkvmerge wrote {}".format(len(pieces), len(files)))
+
+        limit = asyncio.Semaphore(SPLIT_EDIT_JOBS)
+
+        async def title(file, piece):
+            async with limit:
+                (returncode, _) = await capture_process(["mkvpropedit", file, "--edit", "info",
+                                                         "--set", "title={} - {}".format(name, piece[1])])
+            if returncode not in [0, 1]:
+                raise MkabookError("Could not set the title of: {}".format(piece[1]))
+
+        await run_all([title(x, y) for (x, y) in zip(files, pieces)])
+
+        # The pieces are only moved beside the output once all are complete
+        outputs = []
+        for (index, (file, piece)) in enumerate(zip(files, pieces)):
+            output_file = os.path.join(output_dir, "{} - {:03} - {}.mka".format(
+                name, index + 1, safe_filename(piece[1])))
+            shutil.move(file, output_file)
+            outputs.append(output_file)
+
+    result = Split(outputs)
+    result.elapsed = time.monotonic() - start_time
+    result.audio_duration = duration
+    return result
+
+
+# Where to cut a book, as a list of (start, title) of every piece. Durations
+# group whole chapters into parts, only cutting inside a chapter longer than
+# the duration.
+def plan_split(mode, chapters, duration):
+    if mode == "chapters":
+        if not chapters:
+            raise MkabookError("The book has no chapters to split at")
+        # Anything before the first chapter stays with it
+        return [(0.0, chapters[0][1])] + chapters[1:]
+
+    length = parse_duration(mode)
+    starts = [x[0] for x in chapters if 0 < x[0] < duration] + [duration]
+    cuts = [0.0]
+    for (previous, start) in zip([0.0] + starts, starts):
+        # Close the part at this chapter if the chapter won't fit into it
+        if start - cuts[-1] > length and previous > cuts[-1]:
+            cuts.append(previous)
+        while start - cuts[-1] > length:
+            cuts.append(cuts[-1] + length)
+
+    return [(x, "Part {}".format(i + 1)) for (i, x) in enumerate(cuts)]
+
+
+# The (start, title) of the top level chapters of a file
+async def read_chapters(path):
+    (returncode, output) = await capture_process(["ffprobe", "-v", "error", "-print_format", "json",
+                                                  "-show_chapters", path])
+    try:
+        chapters = json.loads(output)["chapters"]
+        return [(float(x["start_time"]), x.get("tags", {}).get("title", "Chapter {}".format(i + 1)))
+                for (i, x) in enumerate(chapters)]
+    except (ValueError, KeyError):
+        raise MkabookError("Could not read the chapters of: {}".format(path))
+
+
+# Parse a duration like "2h", "90m", or "3600" (seconds) into seconds
+def parse_duration(duration):
+    UNITS = {"h": 3600, "m": 60, "s": 1}
+    duration = duration.strip().lower()
+    try:
+        if duration and duration[-1] in UNITS:
+            seconds = float(duration[:-1]) * UNITS[duration[-1]]
+        else:
+            seconds = float(duration)
+    except ValueError:
+        raise MkabookError("Not a duration: {}".format(duration))
+
+    # Splitting into parts of no length would never reach the end
+    if not (seconds > 0 and math.isfinite(seconds)):
+        raise MkabookError("Not a positive duration: {}".format(duration))
+    return seconds
+
+
+# Parse a HH:MM:SS.mmm chapter timestamp into seconds
+def parse_timestamp(timestamp):
+    seconds = 0.0
+    for part in timestamp.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+# Make a chapter title usable as part of a file name
+def safe_filename(title):
+    return re.sub(r'[/\\:*?"<>|\x00-\x1f]', "_", title).strip(" .") or "Untitled"
+
+
+################################################################################
+#  Media Probing                                                               #
+################################################################################
+
+# Probe several media files concurrently. Results are kept in the cache and
+# reused while a file's size and mtime don't change. Returns, in order, a dict
+# for each file describing its first audio stream. With `loudness` the dicts
+# also hold a loudness measurement, which decodes the file the first time.
+# Callers probing many books at once pass one `limit` shared by all of them.
+async def probe_files(paths, config, loudness=False, limit=None):
+    # Probing works without the cache, it is just slower
+    try:
+        cache = open_cache(config)
+    except (OSError, sqlite3.Error):
+        cache = None
+
+    if limit is None:
+        limit = asyncio.Semaphore(available_cores() * 2)
+    # Measuring decodes the whole file
+    decode_limit = loudness_limit()
+
+    async def probe(path):
+        st = os.stat(path)
+        info = None
+        if cache is not None:
+            info = cache.lookup_probe(path, st)
+
+        if info is None:
+            async with limit:
+                info = await probe_file(path)
+            if cache is not None:
+                cache.store_probe(path, st, info)
+
+        if loudness and "loudness" not in info:
+            async with decode_limit:
+                info["loudness"] = await measure_loudness(path)
+            if cache is not None:
+                cache.store_probe(path, st, info)
+        return info
+
+    try:
+        return await run_all([probe(x) for x in paths])
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+# Read the container and first audio stream information with ffprobe, only
+# the headers are read so no audio is decoded
+async def probe_file(path):
+    (returncode, output) = await capture_process(["ffprobe", "-v", "error", "-print_format", "json",
+                                                  "-show_format", "-show_streams", "-select_streams", "a:0", path])
+    try:
+        data = json.loads(output)
+        format = data["format"]
+        stream = data["streams"][0]
+        tags = {}
+        for source in [format.get("tags", {}), stream.get("tags", {})]:
+            tags.update({k.lower(): v for (k, v) in source.items()})
+
+        return {
+            "duration": float(format["duration"]),
+            "codec": stream.get("codec_name"),
+            "sample_rate": int(stream["sample_rate"]) if "sample_rate" in stream else None,
+            "channels": stream.get("channels"),
+            "channel_layout": stream.get("channel_layout"),
+            "bit_rate": int(stream.get("bit_rate") or format.get("bit_rate") or 0) or None,
+            "title": tags.get("title"),
+        }
+    except (ValueError, KeyError, IndexError):
+        raise MkabookError("Could not probe: {}".format(path))
+
+
+# Loudness measurements of every event loop, so all books of a batch share
+# one limit
+LOUDNESS_LIMITS = weakref.WeakKeyDictionary()
+
+
+def loudness_limit():
+    loop = asyncio.get_running_loop()
+    if loop not in LOUDNESS_LIMITS:
+        LOUDNESS_LIMITS[loop] = asyncio.Semaphore(available_cores())
+    return LOUDNESS_LIMITS[loop]
+
+
+# Measure the EBU R128 integrated loudness (LUFS) and true peak (dBTP) of the
+# first audio stream of a file
+async def measure_loudness(path):
+    values = {}
+
+    # The summary at the end holds the values for the whole file, the
+    # measurements of every frame are only logged at the verbose level
+    def on_line(line):
+        match = re.match(r"\s*(I|Peak):\s*(-?inf|-?[\d.]+)", line)
+        if match:
+            values[match.group(1)] = float(match.group(2))
+
+    (returncode, _) = await spawn(["ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-i", path, "-map", "0:a:0",
+                                   "-af", "ebur128=peak=true:framelog=verbose", "-f", "null", "-"],
+                                  lambda line: None, on_line)
+
+    if returncode != 0 or "I" not in values or "Peak" not in values:
+        raise MkabookError("Could not measure the loudness of: {}".format(path))
+    return {"integrated": values["I"], "peak": values["Peak"]}
+
+
+# Format seconds as a HH:MM:SS.mmm chapter timestamp
+def format_timestamp(seconds):
+    ms = int(round(seconds * 1000))
+    return "{:02}:{:02}:{:02}.{:03}".format(ms // 3600000, (ms // 60000) % 60, (ms // 1000) % 60, ms % 1000)
+
+
+################################################################################
+#  Caching                                                                     #
+################################################################################
+
+# Bump this when the layout of cached entries changes
+CACHE_VERSION = 1
+
+
+# Persistent cache of encoded segments and media probe results, indexed by an
+# SQLite database so that several batch workers can share it
+class Cache:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, "segments"), exist_ok=True)
+        os.makedirs(os.path.join(root, "covers"), exist_ok=True)
+        # Lookups may run on a worker thread, but never concurrently
+        self.db = sqlite3.connect(os.path.join(
+            root, "cache.sqlite"), timeout=60, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS covers (key TEXT PRIMARY KEY, ext TEXT, size INTEGER, last_used REAL)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, version INTEGER, data TEXT)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    # Content hash of a file, only re-hashed when its size or mtime changes
+    def fingerprint(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        row = self.db.execute("SELECT digest FROM fingerprints WHERE path = ? AND size = ? AND mtime_ns = ?",
+                              (path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+
+        digest = hash_file(path)
+        self.db.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                        (path, st.st_size, st.st_mtime_ns, digest))
+        self.db.commit()
+        return digest
+
+    def lookup_probe(self, path, st):
+        row = self.db.execute("SELECT data FROM probes WHERE path = ? AND size = ? AND mtime_ns = ? AND version = ?",
+                              (os.path.abspath(path), st.st_size, st.st_mtime_ns, CACHE_VERSION)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def store_probe(self, path, st, info):
+        self.db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)",
+                        (os.path.abspath(path), st.st_size, st.st_mtime_ns, CACHE_VERSION, json.dumps(info)))
+        self.db.commit()
+
+    def segment_key(self, digest, options):
+        return hashlib.sha256(json.dumps([CACHE_VERSION, digest, options]).encode("utf-8")).hexdigest()
+
+    def segment_path(self, key):
+        return os.path.join(self.root, "segments", key[:2], key + ".mka")
+
+    # Find a cached segment and link it to `link_path`, so a concurrent
+    # eviction can't remove it while it is used
+    def lookup_segment(self, key, link_path):
+        path = self.segment_path(key)
+        row = self.db.execute(
+            "SELECT size FROM segments WHERE key = ?", (key,)).fetchone()
+        if row is None or not os.path.isfile(path):
+            return None
+
+        self.db.execute(
+            "UPDATE segments SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+
+        try:
+            os.link(path, link_path)
+            return link_path
+        except OSError:
+            return path
+
+    def store_segment(self, key, file):
+        path = self.segment_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Copy next to the destination first so the rename is atomic
+        tmp_path = path + ".tmp{}".format(os.getpid())
+        try:
+            os.link(file, tmp_path)
+        except OSError:
+            shutil.copyfile(file, tmp_path)
+        os.replace(tmp_path, path)
+
+        self.db.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?)",
+                        (key, os.path.getsize(path), time.time()))
+        self.db.commit()
+
+    # Covers are keyed by the content of the source image and the settings
+    # it was processed with
+    def cover_key(self, digest, max_size, quality):
+        return hashlib.sha256(json.dumps([CACHE_VERSION, "cover", digest, max_size, quality]).encode("utf-8")).hexdigest()
+
+    def cover_path(self, key, ext):
+        return os.path.join(self.root, "covers", key[:2], key + ext)
+
+    def lookup_cover(self, key):
+        row = self.db.execute(
+            "SELECT ext FROM covers WHERE key = ?", (key,)).fetchone()
+        if row is None or not os.path.isfile(self.cover_path(key, row[0])):
+            return None
+
+        self.db.execute(
+            "UPDATE covers SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        return self.cover_path(key, row[0])
+
+    def store_cover(self, key, file):
+        ext = os.path.splitext(file)[1].lower()
+        path = self.cover_path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp{}".format(os.getpid())
+        shutil.copyfile(file, tmp_path)
+        os.replace(tmp_path, path)
+
+        self.db.execute("INSERT OR REPLACE INTO covers VALUES (?, ?, ?, ?)",
+                        (key, ext, os.path.getsize(path), time.time()))
+        self.db.commit()
+        return path
+
+    # Remove least recently used segments and covers until the cache fits in
+    # max_size, returns the number of entries and bytes removed
+    def evict(self, max_size):
+        max_bytes = parse_size(max_size)
+        rows = [("segments", key, self.segment_path(key), size, last_used) for (key, size, last_used) in
+                self.db.execute("SELECT key, size, last_used FROM segments")]
+        rows += [("covers", key, self.cover_path(key, ext), size, last_used) for (key, ext, size, last_used) in
+                 self.db.execute("SELECT key, ext, size, last_used FROM covers")]
+        rows.sort(key=lambda x: x[4], reverse=True)
+
+        total = 0
+        removed = []
+        for (table, key, path, size, _) in rows:
+            if not os.path.isfile(path):
+                removed.append((table, key, path, 0))
+            elif total + size > max_bytes:
+                removed.append((table, key, path, size))
             else:
-                good_msg("Converted Chapters file", **output_args)
+                total += size
+
+        for (table, key, path, _) in removed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.db.execute(
+                "DELETE FROM {} WHERE key = ?".format(table), (key,))
+        self.db.commit()
+
+        return (len(removed), sum([x[3] for x in removed]))
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "mkabook")
+
+
+def open_cache(config):
+    return Cache(config["cache_dir"] or default_cache_dir())
+
+
+def apply_cache_args(args, config):
+    if args.segment_cache:
+        config["segment_cache"] = True
+    if args.cache_dir is not None:
+        config["cache_dir"] = os.path.abspath(args.cache_dir)
+    if args.cache_size is not None:
+        config["cache_size"] = args.cache_size
+
+
+def handle_prune_cache(args):
+    config = DEFAULTS.copy()
+    apply_cache_args(args, config)
+
+    try:
+        cache = open_cache(config)
+        (count, size) = cache.evict(config["cache_size"])
+        cache.close()
+    except Exception as e:
+        fail_msg("Could not prune the cache: {}".format(e))
+        sys.exit(1)
+
+    good_msg("Removed {} segments and covers ({:.1f} MiB) from the cache".format(
+        count, size / (1024 * 1024)))
+
+
+# Cover processing of every event loop, so all books of a batch share it
+COVER_WORKERS = weakref.WeakKeyDictionary()
+
+
+def cover_workers():
+    loop = asyncio.get_running_loop()
+    if loop not in COVER_WORKERS:
+        COVER_WORKERS[loop] = CoverWorkers()
+    return COVER_WORKERS[loop]
+
+
+# Pool processing covers into the cache, at most one per core at a time.
+# Processed covers count towards the cache size like segments.
+# Covers are keyed by their content and the processing settings, so the same
+# cover used by several books, or an unchanged cover of a rebuilt book, is
+# only processed once. Books asking for a cover already being processed wait
+# for it rather than processing it again.
+class CoverWorkers:
+    def __init__(self):
+        self.limit = asyncio.Semaphore(available_cores())
+        self.pending = {}
+
+    # The path of the processed cover in the cache
+    async def process(self, source, config, output_args):
+        cache = open_cache(config)
+        try:
+            digest = await asyncio.to_thread(cache.fingerprint, source)
+            key = cache.cover_key(
+                digest, config["cover_max_size"], config["cover_quality"])
+            path = cache.lookup_cover(key)
+        finally:
+            cache.close()
+        if path is not None:
+            return path
+
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(
+                self.render(source, key, config, output_args))
+            self.pending[key].add_done_callback(
+                lambda _: self.pending.pop(key, None))
+        # A book giving up must not cancel the cover for the others
+        return await asyncio.shield(self.pending[key])
+
+    async def render(self, source, key, config, output_args):
+        size = config["cover_max_size"]
+        async with self.limit:
+            with tempfile.TemporaryDirectory(prefix="mkabook", dir=config["scratch_dir"]) as tmp_dir:
+                output = os.path.join(tmp_dir, "cover.jpg")
+                await run_process("Processing cover", ["ffmpeg", "-nostdin", "-y", "-i", source, "-frames:v", "1",
+                                                       "-vf", "scale='min(iw,{0})':'min(ih,{0})':force_original_aspect_ratio=decrease".format(size),
+                                                       "-q:v", str(config["cover_quality"]), output], **output_args)
+
+                # Small covers may already be compressed better
+                if os.path.getsize(output) >= os.path.getsize(source):
+                    output = source
+
+                cache = open_cache(config)
+                try:
+                    path = cache.store_cover(key, output)
+                finally:
+                    cache.close()
 
-        # Merge into a temporary file
-        merge_options = ["mkvpropedit"]
+        good_msg("Cover reduced from {:.1f} to {:.1f} KiB".format(
+            os.path.getsize(source) / 1024, os.path.getsize(path) / 1024), **output_args)
+        return path
 
-        something_to_do = False
-        if config["chapter_file"]:
-            something_to_do = True
-            merge_options += ["--chapters", config["chapter_file"]]
 
-        # FIXME: Don't know how to edit cover file information
-        # if config["cover_file"]:
-        #     something_to_do = True
-        #     merge_options += ["--attachment-description",
-        #                       "Cover", "--replace-attachment", "name:" + config["cover_file"]]
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
 
-        # Merge into the existing output file
-        merge_options += [config["output_file"]]
 
-        if not something_to_do:
-            return Skipped()
+# Parse a size like "512M" or "10G" into bytes
+def parse_size(size):
+    if isinstance(size, int):
+        return size
 
-        poll_process("Updating MKV Meta-data", merge_options,
-                     **output_args)
+    UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
 
-        #shutil.move(os.path.join(tmp_dir, "tmp.mka"), config["output_file"])
 
-    return Updated(config["chapter_file"] is not None, config["cover_file"] is not None, False)
+################################################################################
+#  Library Indexing                                                            #
+################################################################################
 
+# Most directories scanned at once while indexing a library. Scanning is
+# mostly waiting on the filesystem, so this doesn't depend on the cores.
+INDEX_JOBS = 16
+
+
+# The files of a book directory, read with a single scan
+class BookIndex:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.abspath(path))
+        self.files = {}
+        self.directories = []
+        self.links = []
+
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    if entry.is_symlink():
+                        self.links.append(entry.path)
+                    else:
+                        self.directories.append(entry.path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    self.files[entry.name] = (st.st_size, st.st_mtime_ns)
+
+        self.audio_files = sorted([x for x in self.files if os.path.splitext(x)[1] in AUDIO_EXTENSION],
+                                  key=natural_key)
+
+    # The first of `names` present in the directory
+    def find(self, names):
+        for name in names:
+            if name in self.files:
+                return name
+        return None
+
+    # The (name, size, mtime) of every file, or of only the `candidates`
+    def signature(self, candidates=None):
+        return sorted([[name, size, mtime_ns] for (name, (size, mtime_ns)) in self.files.items()
+                       if candidates is None or name in candidates])
+
+
+# Find every book in a library, scanning directories in parallel. Each
+# directory holding audio files is a book, any other directory (such as a
+# series) is searched for books further down. Nested books are named after
+# their path within the library.
+async def index_library(root):
+    limit = asyncio.Semaphore(INDEX_JOBS)
+    books = []
+
+    async def walk(path, names):
+        async with limit:
+            index = await asyncio.to_thread(BookIndex, path)
+
+        if index.audio_files:
+            index.name = " - ".join(names)
+            books.append(index)
+            return
+
+        # Links are only followed at the top of the library, further down
+        # they could loop
+        await asyncio.gather(*[walk(x, names + [os.path.basename(x)]) for x in index.directories])
+
+    top = BookIndex(root)
+    await asyncio.gather(*[walk(x, [os.path.basename(x)]) for x in top.directories + top.links])
+
+    return sorted(books, key=lambda x: natural_key(x.name))
+
+
+# Sort key ordering the numbers in names by value, so "2.mp3" comes before
+# "10.mp3"
+def natural_key(name):
+    return [int(x) if i % 2 else x.lower() for (i, x) in enumerate(re.split(r"(\d+)", name))]
 
-def process_conversion(work_dir, config, output_args):
-    # Exectute everything within the context of the Temporary directory
-    with tempfile.TemporaryDirectory(prefix="mkabook") as tmp_dir:
-        # Check if the chapters need conversion and create a temp xml file
 
-        if config["chapter_file"] is not None:
-            try:
-                if os.path.splitext(config["chapter_file"])[1] != ".xml":
-                    chapters = Chapters(os.path.join(
-                        work_dir, config["chapter_file"]))
-
-                    with open(os.path.join(tmp_dir, "chapters.xml"), "w") as chap_file:
-                        chapters.write(chap_file, config)
-                    config["chapter_file"] = os.path.join(
-                        tmp_dir, "chapters.xml")
-                else:
-                    config["chapter_file"] = os.path.join(
-                        work_dir, config["chapter_file"])
-            except Exception as e:
-                fail_msg("Failed to convert chapters file", **output_args)
-                raise Exception("Failed to convert chapter file")
-            else:
-                good_msg("Converted Chapters file", **output_args)
+################################################################################
+#  Manifest                                                                    #
+################################################################################
 
-        if len(config["input_files"]) > 1:
-            # Merge files
-            sorted_input = sorted(config["input_files"])
+# Record of the books built into an output directory and the state of the
+# files they were built from
+class Manifest:
+    FILE_NAME = ".mkabook.sqlite"
+
+    NEW = "new"
+    STALE = "stale"
+    METADATA_STALE = "meta-data changed"
+    UP_TO_DATE = "up to date"
+
+    def __init__(self, output_dir):
+        self.dir = os.path.abspath(output_dir)
+        self.db = sqlite3.connect(os.path.join(
+            output_dir, Manifest.FILE_NAME), timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS books (book TEXT PRIMARY KEY, output_file TEXT, files TEXT, options TEXT, config TEXT, output_size INTEGER, output_mtime_ns INTEGER, updated REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS builds (codec TEXT, audio_duration REAL, elapsed REAL, output_size INTEGER, recorded REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS verified (output_file TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, decoded INTEGER, problems TEXT, checked REAL)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    # Outputs are recorded relative to the manifest, so runs from any working
+    # directory find them, and the output directory can be moved
+    def relative(self, output_file):
+        return os.path.relpath(os.path.abspath(output_file), self.dir)
+
+    def resolve(self, output_file):
+        path = os.path.join(self.dir, output_file)
+        # Older manifests hold the path relative to the directory the build
+        # ran in
+        if not os.path.exists(path) and os.path.exists(output_file):
+            return os.path.abspath(output_file)
+        return path
+
+    def lookup(self, book):
+        row = self.db.execute("SELECT output_file, files, options, output_size, output_mtime_ns FROM books WHERE book = ?", (book,)).fetchone()
+        if row is None:
+            return None
+        return (self.resolve(row[0]),) + row[1:]
+
+    # Decide whether a book needs building by comparing the recorded state
+    # against the current one, without opening any of the files
+    def status(self, book, signature, options):
+        row = self.lookup(book)
+        if row is None:
+            return Manifest.NEW
+
+        (output_file, files, recorded_options, size, mtime_ns) = row
+        try:
+            st = os.stat(output_file)
+        except OSError:
+            return Manifest.NEW
+
+        if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+            return Manifest.STALE
+        if files is None:
+            return Manifest.STALE
+        if files == json.dumps(signature) and recorded_options == json.dumps(options, sort_keys=True):
+            return Manifest.UP_TO_DATE
+
+        # Changes limited to the cover, chapters, and tags don't affect the
+        # audio
+        audio = [x for x in signature if not metadata_file(x[0])]
+        if audio != [x for x in json.loads(files) if not metadata_file(x[0])]:
+            return Manifest.STALE
+        recorded_options = json.loads(recorded_options)
+        for name in METADATA_OPTIONS:
+            recorded_options.pop(name, None)
+        if recorded_options != {k: v for (k, v) in options.items() if k not in METADATA_OPTIONS}:
+            return Manifest.STALE
+
+        return Manifest.METADATA_STALE
+
+    def begin(self, book, output_file):
+        self.db.execute("INSERT OR REPLACE INTO books VALUES (?, ?, NULL, NULL, NULL, -1, -1, ?)",
+                        (book, self.relative(output_file), time.time()))
+        self.db.commit()
+
+    def record(self, book, signature, options, config, output_file):
+        try:
+            st = os.stat(output_file)
+        except OSError:
+            return
+
+        self.db.execute("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (book, self.relative(output_file), json.dumps(signature), json.dumps(
+            options, sort_keys=True), json.dumps(config, sort_keys=True), st.st_size, st.st_mtime_ns, time.time()))
+        self.db.commit()
+
+    # Every recorded book with its output, the configuration it was built
+    # with, which is None for builds that never finished, and whether the
+    # output's location is certain. Outputs recorded by older versions
+    # relative to another working directory can't be found from here.
+    def books(self):
+        books = []
+        for (book, output_file, config) in self.db.execute("SELECT book, output_file, config FROM books ORDER BY book"):
+            path = self.resolve(output_file)
+            located = os.path.isabs(output_file) or not os.path.dirname(
+                output_file) or os.path.exists(path)
+            books.append((book, path, json.loads(config)
+                         if config else None, located))
+        return books
+
+    # Make the next --diff rebuild a book whatever the state of its files
+    def invalidate(self, book):
+        self.db.execute("UPDATE books SET files = NULL WHERE book = ?", (book,))
+        self.db.commit()
+
+    # The problems found by an earlier verification of an output which hasn't
+    # changed since, or None. Verifications that decoded the audio count for
+    # those which don't.
+    def lookup_verification(self, output_file, st, decode):
+        row = self.db.execute("SELECT decoded, problems FROM verified WHERE output_file = ? AND size = ? AND mtime_ns = ?",
+                              (self.relative(output_file), st.st_size, st.st_mtime_ns)).fetchone()
+        if row is None or (decode and not row[0]):
+            return None
+        return json.loads(row[1])
+
+    def record_verification(self, output_file, st, decode, problems):
+        self.db.execute("INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?, ?)",
+                        (self.relative(output_file), st.st_size, st.st_mtime_ns, int(decode), json.dumps(problems), time.time()))
+        self.db.commit()
+
+    # Keep how long converting a book took and how large it came out, --plan
+    # estimates later builds from these
+    def record_build(self, codec, audio_duration, elapsed, output_file):
+        if not audio_duration or elapsed <= 0:
+            return
+        try:
+            size = os.path.getsize(output_file)
+        except OSError:
+            return
+
+        self.db.execute("INSERT INTO builds VALUES (?, ?, ?, ?, ?)",
+                        (codec, audio_duration, elapsed, size, time.time()))
+        self.db.commit()
+
+    # The realtime factor and output bytes per second of audio of every
+    # codec, over its most recent builds
+    def build_history(self):
+        builds = collections.defaultdict(list)
+        for (codec, audio_duration, elapsed, size) in self.db.execute("SELECT codec, audio_duration, elapsed, output_size FROM builds ORDER BY recorded DESC"):
+            if len(builds[codec]) < PLAN_HISTORY:
+                builds[codec].append((audio_duration, elapsed, size))
+
+        history = {}
+        for (codec, rows) in builds.items():
+            audio_duration = sum([x[0] for x in rows])
+            history[codec] = {
+                "builds": len(rows),
+                "realtime_factor": audio_duration / sum([x[1] for x in rows]),
+                "output_bytes_per_second": sum([x[2] for x in rows]) / audio_duration,
+            }
+        return history
+
+
+# Open the manifest for the output location, it is kept in the output
+# directory so that it travels with the library it describes
+def open_manifest(args, output_args, output_dir=None):
+    if output_dir is None:
+        output_dir = output_directory(args)
+    if not os.path.isdir(output_dir):
+        return None
 
-            with open(os.path.join(tmp_dir, "concat.txt"), 'w') as c:
-                for input in sorted_input:
-                    c.write("file " + "'" + input + "'\n")
+    try:
+        return Manifest(output_dir)
+    except sqlite3.Error as e:
+        warn_msg("Could not open the manifest: {}".format(e), **output_args)
+        return None
 
-            # p = subprocess.Popen(["ffmpeg", "-f", "concat", "-safe", "0", "-i", os.path.join(
-            #     tmp_dir, "concat.txt"), "-c", "copy", os.path.join(tmp_dir, "concat.mka")], **REDIRECT_ARGS)
-            # poll_message(p, prefix + "Merging audio tracks")
-            poll_process("Merging audio tracks", ["ffmpeg", "-f", "concat", "-safe", "0", "-i", os.path.join(
-                tmp_dir, "concat.txt"), "-c", "copy", os.path.join(tmp_dir, "concat.mka")], **output_args)
 
-            config["input_file"] = os.path.join(tmp_dir, "concat.mka")
-        else:
-            config["input_file"] = config["input_files"][0]
+# The directory outputs are written to, -o may name either it or a file
+def output_directory(args):
+    if os.path.isdir(args.output):
+        return args.output
+    return os.path.dirname(os.path.abspath(args.output))
 
-        # p = subprocess.Popen(["ffmpeg", "-i", config["input_file"], "-acodec",
-        #                       config["codec"], os.path.join(tmp_dir, "converted.mka")], **REDIRECT_ARGS)
-        # poll_message(p, prefix + "Converting Audio")
 
-        poll_process("Converting Audio", ["ffmpeg", "-i", config["input_file"], "-acodec",
-                                          config["codec"], os.path.join(tmp_dir, "converted.mka")], **output_args)
+# The (name, size, mtime) of every file a book can be built from
+def book_signature(input, index):
+    if os.path.isdir(input):
+        return index.signature()
 
-        merge_options = ["mkvmerge", "-o", config["output_file"]]
+    return index.signature([os.path.basename(input), "config.json"] +
+                           COVER_SEARCH_ITEMS + CHAPTERS_SEARCH_ITEMS + TAGS_SEARCH_ITEMS)
 
-        if config["chapter_file"]:
-            merge_options += ["--chapters", config["chapter_file"]]
 
-        if config["cover_file"]:
-            merge_options += ["--attachment-description",
-                              "Cover", "--attach-file", config["cover_file"]]
+# Whether a file in an input directory only contributes meta-data
+def metadata_file(name):
+    return os.path.splitext(name)[1] not in AUDIO_EXTENSION and name != "config.json"
 
-        # Input is our temp file
-        merge_options += [os.path.join(tmp_dir, "converted.mka")]
 
-        # p = subprocess.Popen(
-        #     merge_options, **REDIRECT_ARGS)
+# Command line options which only change the meta-data of a book
+METADATA_OPTIONS = ["cover", "cover_size", "cover_quality", "chapters", "tags",
+                    "use_sub_chapters", "no_auto_chapters"]
 
-        # poll_message(p, prefix + "Merging MKV Meta-data")
-        poll_process("Merging MKV Meta-data", merge_options,
-                     **output_args)
 
-    return Converted(config["codec"], config["chapter_file"] is not None, config["cover_file"] is not None, False)
+# Command line options which change how a book is built
+def manifest_options(args):
+    return {
+        "codec": args.codec,
+        "cover": args.cover,
+        "cover_size": args.cover_size,
+        "cover_quality": args.cover_quality,
+        "chapters": args.chapters,
+        "tags": args.tags,
+        "use_sub_chapters": args.use_sub_chapters,
+        "no_auto_chapters": args.no_auto_chapters,
+        "ignore_cfg": args.ignore_cfg,
+        "normalize": args.normalize,
+        "profile": args.profile,
+        "target_loudness": args.target_loudness,
+        "target": args.target,
+    }
 
 
-class ConversionResponse:
-    pass
+################################################################################
+#  Metrics                                                                     #
+################################################################################
 
+# Collects timing and throughput of every stage and writes them as JSON lines
+class Metrics:
+    def __init__(self, path):
+        self.file = open(path, "a")
+        self.start = time.monotonic()
+        self.stage_times = collections.defaultdict(list)
+        self.books = 0
+        self.errors = 0
+        self.audio_duration = 0.0
+
+    def write(self, record):
+        record["time"] = time.time()
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    # Write the summary of everything recorded and close the file
+    def close(self):
+        summary = self.summary()
+        self.write(summary)
+        self.file.close()
+        return summary
+
+    def summary(self):
+        wall_time = time.monotonic() - self.start
+        stages = {}
+        for (stage, times) in self.stage_times.items():
+            stages[stage] = {
+                "count": len(times),
+                "total": sum(times),
+                "p50": percentile(times, 50),
+                "p95": percentile(times, 95),
+            }
+
+        return {
+            "type": "summary",
+            "books": self.books,
+            "errors": self.errors,
+            "wall_time": wall_time,
+            "audio_duration": self.audio_duration,
+            "realtime_factor": ratio(self.audio_duration, wall_time),
+            "stages": stages,
+        }
 
-class Converted:
-    def __init__(self, codec, has_chapters, has_cover, has_info):
-        self.codec = codec
-        self.has_chapters = has_chapters
-        self.has_cover = has_cover
-        self.has_info = has_info
 
-    def __str__(self):
-        return "Converted\n\tCodec: {}\n\tChapters: {}\n\tCover: {}\n\tTags: {}".format(self.codec, self.has_chapters, self.has_cover, self.has_info)
+# Totals for a single item, every item has one even without a metrics file
+class BookMetrics:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = time.monotonic()
+        self.elapsed = None
+        self.cpu_time = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.audio_duration = None
+
+    def stage(self, stage, wall_time, usage, duration, returncode):
+        if usage is not None:
+            self.cpu_time += usage["cpu_time"]
+            self.bytes_read += usage["bytes_read"]
+            self.bytes_written += usage["bytes_written"]
+        # The longest stage is the one producing the whole book
+        if duration:
+            self.audio_duration = max(self.audio_duration or 0, duration)
+
+        if self.metrics is None:
+            return
+
+        self.metrics.stage_times[stage].append(wall_time)
+        self.metrics.write({
+            "type": "stage",
+            "book": self.name,
+            "stage": stage,
+            "wall_time": wall_time,
+            "cpu_time": usage["cpu_time"] if usage else None,
+            "bytes_read": usage["bytes_read"] if usage else None,
+            "bytes_written": usage["bytes_written"] if usage else None,
+            "audio_duration": duration,
+            "realtime_factor": ratio(duration, wall_time),
+            "returncode": returncode,
+        })
 
+    def finish(self, result):
+        self.elapsed = time.monotonic() - self.start
+        if self.metrics is None:
+            return
+
+        error = isinstance(result, Exception)
+        self.metrics.books += 1
+        if error:
+            self.metrics.errors += 1
+        elif self.audio_duration:
+            self.metrics.audio_duration += self.audio_duration
+
+        self.metrics.write({
+            "type": "book",
+            "book": self.name,
+            "result": type(result).__name__,
+            "error": str(result) if error else None,
+            "wall_time": self.elapsed,
+            "cpu_time": self.cpu_time,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "audio_duration": self.audio_duration,
+            "realtime_factor": ratio(self.audio_duration, self.elapsed),
+        })
 
-class Skipped(ConversionResponse):
-    pass
 
-    def __str__(self):
-        return "Already exits, nothing to do"
+# Time a stage which isn't a subprocess
+@contextlib.contextmanager
+def measure_stage(output_args, stage):
+    start = time.monotonic()
+    yield
+    if output_args.get("metrics") is not None:
+        output_args["metrics"].stage(
+            stage, time.monotonic() - start, None, None, 0)
 
 
-class Updated:
-    def __init__(self, has_chapters, has_cover, has_info):
-        self.has_chapters = has_chapters
-        self.has_cover = has_cover
-        self.has_info = has_info
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(pct / 100 * len(values))) - 1)]
+
+
+def ratio(a, b):
+    if not a or not b:
+        return None
+    return a / b
 
-    def __str__(self):
-        return "Updated\n\tChapters: {}\n\tCover: {}\n\tTags: {}".format(self.has_chapters, self.has_cover, self.has_info)
 
 ################################################################################
 #  Arguments                                                                   #
 ################################################################################
 
 
-def parse_args():
+def parse_args(argv=None):
+    return make_parser().parse_args(argv)
+
+
+def make_parser():
     parser = argparse.ArgumentParser(
         description="A tool for creating MKV based audiobooks: {}".format(VERSION))
 
-    parser.add_argument("INPUT_FILE_OR_DIR")
+    parser.add_argument("INPUT_FILE_OR_DIR", nargs="?")
     parser.add_argument(
-        "--codec", choices=["libfdk_aac", "aac", "flac", "mp3", "copy"], help="Set the codec to use for the audio track. 'copy' will perorm no conversion. [Default: libfdk_aac]")
+        "--codec", choices=["libfdk_aac", "aac", "flac", "mp3", "copy", "auto"], help="Set the codec to use for the audio track. 'copy' will perorm no conversion, 'auto' copies when the inputs allow it and otherwise uses the 'auto_codec' configuration. [Default: libfdk_aac]")
     parser.add_argument(
         "-i", "--ignore-cfg", action='store_true', help="If set mkabook will ignore values set in cfg.json and use defaults or command line values")
     parser.add_argument("--cover", type=str,
                         help="Set the name of the cover image to look for")
+    parser.add_argument("--cover-size", type=int,
+                        help="Shrink covers to at most this many pixels wide and high and recompress them as JPEG. Processed covers are cached by their content")
+    parser.add_argument("--cover-quality", type=int,
+                        help="JPEG quality of processed covers, from 2 (best) to 31 [Default: 3]")
     parser.add_argument("--chapters", type=str,
                         help="Specify the chapters file to use, if this file is a txt file in the QT format it will be converted")
+    parser.add_argument("--tags", type=str,
+                        help="Specify the tags file to use, either Matroska XML or a JSON object of tag names and values")
+    parser.add_argument("--no-auto-chapters", action="store_true",
+                        help="Don't create a chapter for every input file when merging files without a chapters file")
     parser.add_argument(
         "--use-sub-chapters", action="store_true", default=False, help="If set, when converting from Text chapters to XML, the tool will output sub-chapters instead of indented titles")
 
+    parser.add_argument("--profile", choices=sorted(PROFILES),
+                        help="Encode with a named set of bitrate, channel, and sample rate settings. speech-low: 32k mono 22kHz, speech-hq: 64k mono 44.1kHz, archive: flac")
+    parser.add_argument("--normalize", action="store_true",
+                        help="Normalize the loudness of the book following EBU R128, the audio has to be converted for this")
+    parser.add_argument("--target-loudness", type=float,
+                        help="Loudness --normalize brings books to in LUFS [Default: -23]")
+
+    parser.add_argument("--target", type=target_arg, action="append",
+                        help="Build the book into this target as well, given as comma separated settings such as 'codec=flac,output=archive'. 'output' is a directory below -o, the other settings are: {}. Every target is encoded from one decode of the inputs, and --diff only skips the targets which are up to date".format(", ".join(TARGET_OPTIONS)))
+
+    parser.add_argument("--split", type=str,
+                        help="Split an existing book into several files without converting it, either at every chapter with 'chapters' or into parts no longer than a duration such as '2h' or '90m', which end at chapters where possible")
+
+    parser.add_argument("--multi-pass", action="store_true",
+                        help="Merge, convert, and mux the audio in separate passes through temporary files instead of a single streaming pass")
+
+    parser.add_argument("--encode-jobs", type=jobs_arg,
+                        help="Encode the input files of a single item on this many processes at once, 'auto' uses the cores left over by --jobs. Single inputs are split into time slices. Only used with flac [Default: 1]")
+
+    parser.add_argument("--segment-cache", action="store_true",
+                        help="Keep the encoded audio of every input file in the cache directory, rebuilding a book only encodes new or changed inputs. Only used with flac")
+    parser.add_argument("--cache-dir", type=str,
+                        help="Directory for cached data [Default: $XDG_CACHE_HOME/mkabook or ~/.cache/mkabook]")
+    parser.add_argument("--cache-size", type=str,
+                        help="Maximum size of the cached segments and covers, the least recently used are evicted beyond this. Accepts K, M, G, and T suffixes [Default: 10G]")
+    parser.add_argument("--prune-cache", action="store_true",
+                        help="Evict segments from the cache until it fits --cache-size, then exit")
+
+    parser.add_argument("--scratch-dir", type=str,
+                        help="Directory for temporary files, such as a fast local disk or tmpfs. Batch jobs wait for enough free space here and in the output directory [Default: the system temporary directory]")
+
     parser.add_argument("-o", "--output", type=str, default=".",
                         help="Output directory or filename. If a directory is provided the output will be the name of the input file directory with the .mka extension")
     parser.add_argument("-v", action="store_true",
                         help="Verbose program output")
     parser.add_argument("-u", "--update-metadata", action="store_true",
-                        help="Don't reconvert the audio, only update the available meta-data [Under construction: Only updates chapter info at this time]")
+                        help="Don't reconvert the audio, only write the chapters, tags, and cover into the headers of the existing output. Books whose meta-data files haven't changed since the last build are skipped")
     parser.add_argument("-d", "--diff", action="store_true",
-                        help="Only process if an existing file isn't in the specified output location. Useful when batch processing.")
+                        help="Only process if an existing file isn't in the specified output location, or its inputs changed since it was built. Useful when batch processing.")
     parser.add_argument("--batch", action="store_true",
                         help="Scan the input directory and treat each sub-directory as a single item.")
-    parser.add_argument("-j", "--jobs", type=int, default=1,
-                        help="How many items to batch process at once")
+    parser.add_argument("--queue-dir", type=str,
+                        help="Share a --batch with other mkabook processes, on this or other hosts, through this directory on shared storage. Every process prints the summary of the whole batch")
+    parser.add_argument("--lease-timeout", type=float, default=120,
+                        help="Seconds after which a book claimed through --queue-dir by a worker which stopped responding is taken over [Default: 120]")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and convert the books in the input directory as they are added or changed, implies --batch and --diff")
+    parser.add_argument("--settle", type=float, default=30,
+                        help="Seconds a book's files must stay unchanged before --watch converts it [Default: 30]")
+    parser.add_argument("--poll", action="store_true",
+                        help="Make --watch rescan the library periodically instead of using inotify, needed for network filesystems")
+    parser.add_argument("--poll-interval", type=float, default=60,
+                        help="Seconds between rescans of the library when polling [Default: 60]")
+    parser.add_argument("--plan", action="store_true",
+                        help="Print what would be done as JSON instead of doing it, with the codec, duration, and estimated output size and encoding time of every book. Encoding times are estimated from earlier builds into the output directory")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check that the books built into the output directory are intact: their headers can be read, they are as long as their inputs, and they have their chapters and cover. Only books below the input are checked when one is given. Broken books are rebuilt by the next --diff, or straight away with --batch. Results are kept until an output changes")
+    parser.add_argument("--verify-decode", action="store_true",
+                        help="Also decode all of the audio of every book while verifying")
+    parser.add_argument("--metrics-file", type=str,
+                        help="Append timing and throughput of every stage of every item to this file as JSON lines, followed by a summary")
+    parser.add_argument("-j", "--jobs", type=jobs_arg, default=1,
+                        help="How many items to batch process at once, 'auto' uses one per core and starts the longest items first")
+
+    return parser
+
+
+# Parse "key=value,key=value" target settings, numbers are converted
+def target_arg(value):
+    spec = {}
+    for item in value.split(","):
+        (key, sep, setting) = item.partition("=")
+        key = key.strip()
+        if not sep or (key not in TARGET_OPTIONS and key != "output"):
+            raise argparse.ArgumentTypeError(
+                "expected settings like 'codec=flac,output=archive', got '{}'".format(item))
+        if key == "normalize":
+            setting = setting.lower() in ["1", "true", "yes"]
+        elif key != "output":
+            for kind in [int, float]:
+                try:
+                    setting = kind(setting)
+                    break
+                except ValueError:
+                    pass
+        spec[key] = setting
+    return spec
 
-    return parser.parse_args()
+
+def jobs_arg(value):
+    if value == "auto":
+        return value
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected a number or 'auto', got '{}'".format(value))
+    if jobs < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return jobs
 
 
 ################################################################################
 #  Batch Processing                                                            #
 ################################################################################
 
-def shim(input):
-    (args, entry) = input
-
-    # Change the item we are looking at
-    args.INPUT_FILE_OR_DIR = entry
+async def shim(args, book, metrics=None, events=None):
+    # Items run side by side, so each gets its own copy of the arguments
+    args = argparse.Namespace(**vars(args))
+    args.INPUT_FILE_OR_DIR = book.path
+    args.book_index = book
 
     try:
-        return handle_single(args, output_args={
+        return (book.name, await handle_single_async(args, output_args={
             "verbose_output": False,
             "dynamic_output": False,
-            "prefix": os.path.basename(entry)
-        })
+            "prefix": book.name,
+            "events": events,
+        }, metrics=metrics))
     except Exception as e:
-        return e
+        return (book.name, e)
 
 
 def handle_batch(args):
@@ -359,34 +2498,33 @@ def handle_batch(args):
         fail_msg("Input expected to be a directory")
         sys.exit(1)
 
-    # Find all sub-directories of the input
-    to_process = []
-    for item in os.listdir(args.INPUT_FILE_OR_DIR):
-        entry = os.path.join(args.INPUT_FILE_OR_DIR, item)
-        if os.path.isdir(entry):
-            to_process.append((args, entry))
+    # Find all books below the input
+    to_process = asyncio.run(index_library(args.INPUT_FILE_OR_DIR))
 
     good_msg("Found {} items to process: {}".format(
-        len(to_process), "\n\t" + "\n\t".join([os.path.basename(x[1]) for x in to_process])))
-    progress_msg("Running with {} Job(s)".format(args.jobs))
+        len(to_process), "\n\t" + "\n\t".join([x.name for x in to_process])))
 
-    # Process the items
-    pool = multiprocessing.Pool(args.jobs)
+    share_cores(args, len(to_process))
+    progress_msg("Running with {} Job(s), {} thread(s) each".format(
+        args.jobs, args.cpu_budget))
 
-    # Figure out which items succeeded and which failed
-    output = pool.map(shim, to_process)
-    potential_errors = zip(to_process, output)
+    metrics = Metrics(args.metrics_file) if args.metrics_file else None
+    results = asyncio.run(run_batch(args, to_process, metrics))
 
     # Give use a nice summary of the processed items
     print("\n" + bcolors.HEADER + "Conversion Summary" + bcolors.ENDC)
     err_count = 0
-    for ((_, name), ret) in potential_errors:
-        if type(ret) is Exception:
-            fail_msg("An Error Ocurred" + "\n\t{}".format(ret),
-                     prefix=os.path.basename(name))
+    for (name, ret) in sorted(results):
+        report_result(name, ret)
+        if isinstance(ret, Exception):
             err_count += 1
-        else:
-            good_msg(ret, prefix=os.path.basename(name))
+
+    if metrics is not None:
+        summary = metrics.close()
+        print("\n" + bcolors.HEADER + "Stage Times" + bcolors.ENDC)
+        for (stage, times) in sorted(summary["stages"].items()):
+            good_msg("{}: {} runs, p50 {:.1f}s, p95 {:.1f}s".format(
+                stage, times["count"], times["p50"], times["p95"]))
 
     print("")
     if err_count > 0:
@@ -394,23 +2532,1060 @@ def handle_batch(args):
     else:
         good_msg("Batch Completed Successfully")
 
+    return results
+
+
+# Split the cores between the jobs, each ffmpeg gets its share as threads
+def share_cores(args, count):
+    cores = available_cores()
+    if args.jobs == "auto":
+        args.jobs = max(1, min(cores, count))
+    args.cpu_budget = max(1, cores // args.jobs)
+
+
+# Results only count for a run writing the same outputs with the same options
+def queue_job(args):
+    job = {
+        "output": os.path.abspath(output_directory(args)),
+        "options": manifest_options(args),
+    }
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+
+# Run every item from a single event loop, at most args.jobs at a time,
+# reporting each one as soon as it finishes
+async def run_batch(args, to_process, metrics=None, events=None):
+    # Start the longest books first so they don't end up as stragglers
+    space = None
+    if args.jobs > 1 and len(to_process) > 1:
+        costs = await estimate_costs(args, to_process, events)
+        to_process = sorted(
+            to_process, key=lambda x: costs[x.path], reverse=True)
+        space = SpaceBudget(output_directory(args),
+                            args.scratch_dir or tempfile.gettempdir(), events)
+
+    limit = asyncio.Semaphore(args.jobs)
+
+    async def run_one(entry):
+        async with limit:
+            if space is None:
+                return await shim(args, entry, metrics, events)
+            async with space.reserve(entry.name, estimate_space(args, *costs[entry.path])):
+                return await shim(args, entry, metrics, events)
+
+    if args.queue_dir:
+        queue = WorkQueue(args.queue_dir, args.lease_timeout, queue_job(args), events)
+        return await run_queue(queue, to_process, run_one, args.jobs)
+
+    # Semaphore waiters are woken in order, so the tasks start in this order
+    tasks = [asyncio.ensure_future(run_one(x)) for x in to_process]
+    results = []
+    for next_result in asyncio.as_completed(tasks):
+        (name, ret) = await next_result
+        report_result(name, ret, events)
+        results.append((name, ret))
+
+    return results
+
+
+def report_result(name, ret, events=None):
+    if isinstance(ret, Exception):
+        fail_msg("An Error Ocurred" + "\n\t{}".format(ret),
+                 prefix=os.path.basename(name), events=events)
+    else:
+        good_msg(ret, prefix=os.path.basename(name), events=events)
+
+
+# Process books claimed from a queue shared with other mkabook processes,
+# possibly on other hosts. Books leased by another worker are waited for,
+# and taken over if that worker stops renewing its lease. Returns the results
+# of every book, whichever worker processed it.
+async def run_queue(queue, books, run_one, jobs):
+    pending = list(books)
+
+    # Claim the next book nobody else is working on, waiting while the
+    # only books left are leased by other workers
+    async def next_book():
+        while True:
+            leased = False
+            for book in list(pending):
+                if queue.finished(book):
+                    pending.remove(book)
+                    continue
+
+                lease = queue.claim(book)
+                if lease is None:
+                    leased = True
+                    continue
+
+                pending.remove(book)
+                return (book, lease)
+
+            if not leased:
+                return (None, None)
+            await asyncio.sleep(queue.poll_interval)
+
+    async def worker():
+        while True:
+            (book, lease) = await next_book()
+            if book is None:
+                return
+
+            heartbeat = asyncio.ensure_future(queue.heartbeat(lease))
+            build = asyncio.ensure_future(run_one(book))
+            try:
+                await asyncio.wait([heartbeat, build], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                heartbeat.cancel()
+                if not build.done():
+                    build.cancel()
+                    await asyncio.gather(build, return_exceptions=True)
+
+            if build.cancelled():
+                warn_msg("Stopped, another worker took over the book",
+                         prefix=book.name, events=queue.events)
+                continue
+
+            (name, ret) = build.result()
+            queue.finish(book, lease, ret)
+            report_result(name, ret, queue.events)
+
+    await asyncio.gather(*[worker() for _ in range(jobs)])
+
+    return [queue.result(x) for x in books]
+
+
+# Estimate how long each book takes to process from the total duration of its
+# input audio, falling back to the total size when durations are unavailable.
+# Books which --diff will skip cost nothing.
+async def estimate_costs(args, books, events=None):
+    manifest = open_manifest(args, {"events": events}) if args.diff else None
+    config = DEFAULTS.copy()
+    apply_cache_args(args, config)
+
+    # Large libraries would otherwise start an ffprobe for every file at once,
+    # and each book being probed holds a connection to the cache
+    books_limit = asyncio.Semaphore(available_cores())
+    probe_limit = asyncio.Semaphore(available_cores() * 2)
+
+    async def estimate(book):
+        async with books_limit:
+            duration = await probe_total_duration([os.path.join(book.path, x) for x in book.audio_files], config, probe_limit)
+        return (duration or 0.0, sum([book.files[x][0] for x in book.audio_files]))
+
+    costs = {}
+    pending = []
+    for book in books:
+        if manifest is not None and manifest.status(os.path.abspath(book.path), book.signature(), manifest_options(args)) == Manifest.UP_TO_DATE:
+            costs[book.path] = (0.0, 0)
+        else:
+            pending.append(book)
+    if manifest is not None:
+        manifest.close()
+
+    for (book, cost) in zip(pending, await asyncio.gather(*[estimate(x) for x in pending])):
+        costs[book.path] = cost
+
+    return costs
+
+
+# A batch shared through a directory every worker can reach. A worker claims
+# a book by creating its lease file, and renews the lease by touching the file
+# while it works. Leases untouched for longer than the timeout belong to
+# crashed workers and may be taken over. Finished books leave a result file,
+# which counts for as long as the book's files don't change.
+class WorkQueue:
+    def __init__(self, root, timeout, job, events=None):
+        self.events = events
+        self.job = job
+        self.leases = os.path.join(root, "leases")
+        self.results = os.path.join(root, "results")
+        os.makedirs(self.leases, exist_ok=True)
+        os.makedirs(self.results, exist_ok=True)
+
+        self.timeout = timeout
+        self.poll_interval = max(1, timeout / 4)
+        self.worker = "{}-{}".format(socket.gethostname(), os.getpid())
+
+    # Hosts may mount the library in different places, books are known by
+    # their name within it
+    def key(self, book):
+        return hashlib.sha1(book.name.encode()).hexdigest()
+
+    def lease_path(self, book):
+        return os.path.join(self.leases, self.key(book) + ".lease")
+
+    def result_path(self, book):
+        return os.path.join(self.results, self.key(book) + ".json")
+
+    def read_result(self, book):
+        try:
+            with open(self.result_path(book), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def finished(self, book):
+        result = self.read_result(book)
+        return (result is not None and not result["error"]
+                and result["signature"] == book.signature()
+                and result.get("job") == self.job)
+
+    # Returns the lease file, or None while another worker holds the book
+    def claim(self, book):
+        path = self.lease_path(book)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.reclaim(book, path):
+                    return None
+                continue
+
+            with os.fdopen(fd, "w") as f:
+                json.dump({"book": book.name, "worker": self.worker}, f)
+            return path
+
+        return None
+
+    # The worker named in a lease file, or None if it can't be read
+    def lease_owner(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f).get("worker")
+        except (OSError, ValueError):
+            return None
+
+    # Remove a lease whose worker stopped renewing it. Between looking at the
+    # lease and renaming it away another worker may have replaced it with a
+    # fresh one of its own, so the renamed file is checked again and put back
+    # unless it is still the expired lease.
+    def reclaim(self, book, path):
+        try:
+            st = os.stat(path)
+            if time.time() - st.st_mtime < self.timeout:
+                return False
+            owner = self.lease_owner(path)
+            stale = "{}.{}.stale".format(path, self.worker)
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return True
+
+        try:
+            renamed = os.stat(stale)
+        except FileNotFoundError:
+            return False
+        if (renamed.st_ino, renamed.st_mtime_ns) != (st.st_ino, st.st_mtime_ns) or \
+                time.time() - renamed.st_mtime < self.timeout or self.lease_owner(stale) != owner:
+            # A lease created since then wins over this one
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+
+        warn_msg("Taking over from {}, its lease expired".format(owner),
+                 prefix=book.name, events=self.events)
+        return True
+
+    # Renew the lease until it is cancelled. Returns if another worker took
+    # the lease over, the book is then theirs.
+    async def heartbeat(self, path):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self.lease_owner(path) != self.worker:
+                return
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    def finish(self, book, lease, ret):
+        result = {
+            "book": book.name,
+            "signature": book.signature(),
+            "job": self.job,
+            "worker": self.worker,
+            "error": isinstance(ret, Exception),
+            "message": str(ret),
+        }
+
+        # Readers never see a partly written result
+        partial = "{}.{}.partial".format(self.result_path(book), self.worker)
+        with open(partial, "w") as f:
+            json.dump(result, f)
+        os.replace(partial, self.result_path(book))
+
+        # A lease taken over meanwhile belongs to the other worker
+        if self.lease_owner(lease) != self.worker:
+            return
+        try:
+            os.remove(lease)
+        except FileNotFoundError:
+            pass
+
+    # The (name, result) of a book as recorded by the worker which processed it
+    def result(self, book):
+        result = self.read_result(book)
+        if result is None:
+            return (book.name, Exception("No worker recorded a result"))
+
+        message = "{}\n\tWorker: {}".format(
+            result["message"], result["worker"])
+        if result["error"]:
+            return (book.name, Exception(message))
+        return (book.name, Reported(message))
+
+
+# Shares the free space of the output and scratch filesystems between batch
+# jobs. A job waits until the space it needs is free, less what the running
+# jobs have reserved, though it always runs when no other job is running.
+class SpaceBudget:
+    def __init__(self, output_dir, scratch_dir, events=None):
+        self.events = events
+        self.paths = {"output": output_dir, "scratch": scratch_dir}
+        self.reserved = {}
+        self.running = 0
+        self.changed = asyncio.Condition()
+
+    # Add up the space needed on each filesystem, output and scratch are
+    # often the same one
+    def by_device(self, need):
+        devices = {}
+        for (kind, size) in need.items():
+            path = self.paths[kind]
+            device = os.stat(path).st_dev
+            devices[device] = (path, devices.get(device, (path, 0))[1] + size)
+        return devices
+
+    def fits(self, devices):
+        for (device, (path, size)) in devices.items():
+            if shutil.disk_usage(path).free - self.reserved.get(device, 0) < size:
+                return False
+        return True
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, name, need):
+        devices = self.by_device(need)
+        async with self.changed:
+            if self.running > 0 and not self.fits(devices):
+                progress_msg("Waiting for disk space",
+                             prefix=name, events=self.events)
+            await self.changed.wait_for(lambda: self.running == 0 or self.fits(devices))
+            if not self.fits(devices):
+                warn_msg("There may not be enough disk space",
+                         prefix=name, events=self.events)
+
+            for (device, (_, size)) in devices.items():
+                self.reserved[device] = self.reserved.get(device, 0) + size
+            self.running += 1
+
+        try:
+            yield
+        finally:
+            async with self.changed:
+                for (device, (_, size)) in devices.items():
+                    self.reserved[device] -= size
+                self.running -= 1
+                self.changed.notify_all()
+
+
+# Bytes of audio per second of 16 bit stereo PCM compressed to about 60%
+LOSSLESS_BYTES_PER_SECOND = 44100 * 2 * 2 * 0.6
+
+
+# Roughly how much space building a book takes on the output and scratch
+# filesystems, from the duration and size of its inputs. Lossy and copied
+# output is taken to be the size of the inputs.
+def estimate_space(args, duration, size):
+    output = size
+    if args.codec == "flac":
+        output = max(size, int(duration * LOSSLESS_BYTES_PER_SECOND))
+
+    # Separate passes keep the merged input and the converted audio around,
+    # segmented encoding keeps the encoded pieces
+    scratch = 0
+    if args.multi_pass:
+        scratch = size + output
+    elif args.encode_jobs not in [None, 1] or args.segment_cache:
+        scratch = output
+
+    return {"output": output, "scratch": scratch}
+
+
+# The number of cores this process is allowed to run on
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+################################################################################
+#  Planning                                                                    #
+################################################################################
+
+# Builds of a codec its estimates are drawn from, older ones may have run on
+# other hardware
+PLAN_HISTORY = 20
+
+
+# Print what processing the input would do as JSON, without converting
+# anything. Inputs are only probed, which reads their headers.
+def handle_plan(args):
+    try:
+        plan = asyncio.run(plan_batch(args))
+    except Exception as e:
+        fail_msg(e)
+        sys.exit(1)
+
+    print(json.dumps(plan, indent=4))
+
+
+async def plan_batch(args):
+    # Only the JSON goes to stdout
+    output_args = {"events": lambda kind, msg, prefix: None}
+
+    if args.watch:
+        args.diff = True
+    if args.batch or args.watch:
+        if not os.path.isdir(args.INPUT_FILE_OR_DIR):
+            raise MkabookError("Input expected to be a directory")
+        books = await index_library(args.INPUT_FILE_OR_DIR)
+        items = []
+        for book in books:
+            item_args = argparse.Namespace(**vars(args))
+            item_args.INPUT_FILE_OR_DIR = book.path
+            items.append((item_args, book))
+    else:
+        work_dir = args.INPUT_FILE_OR_DIR
+        if not os.path.isdir(work_dir):
+            work_dir = os.path.dirname(os.path.abspath(work_dir))
+        items = [(args, BookIndex(work_dir))]
+
+    manifest = open_manifest(args, output_args)
+    history = manifest.build_history() if manifest is not None else {}
+
+    limit = asyncio.Semaphore(available_cores())
+
+    async def plan_one(item_args, index):
+        async with limit:
+            try:
+                return await plan_book(item_args, index, manifest, history, output_args)
+            except Exception as e:
+                return {"name": index.name, "path": os.path.abspath(item_args.INPUT_FILE_OR_DIR), "action": "error", "error": str(e)}
+
+    try:
+        entries = await run_all([plan_one(*x) for x in items])
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    # Jobs are shared out the same way as for the real run
+    share_cores(args, max(1, len([x for x in entries if x["action"] == "convert"])))
+    converting = [x for x in entries if x["action"] == "convert"]
+    times = [x["estimated_encode_time"] for x in converting
+             if x["estimated_encode_time"] is not None]
+    sizes = [x["estimated_output_size"] for x in converting
+             if x["estimated_output_size"] is not None]
+
+    return {
+        "input": os.path.abspath(args.INPUT_FILE_OR_DIR),
+        "output": os.path.abspath(args.output),
+        "jobs": args.jobs,
+        "history": history,
+        "books": entries,
+        "totals": {
+            "books": len(entries),
+            "convert": len(converting),
+            "update": len([x for x in entries if x["action"] == "update"]),
+            "skip": len([x for x in entries if x["action"] == "skip"]),
+            "error": len([x for x in entries if x["action"] == "error"]),
+            "duration": sum([x["duration"] or 0 for x in converting]),
+            "estimated_output_size": sum(sizes),
+            "estimated_encode_time": sum(times),
+            "estimated_wall_time": schedule_time(times, args.jobs),
+            # Books without measured builds of their codec to estimate from
+            "unestimated": len(converting) - len(times),
+        },
+    }
+
+
+# Work out what processing one book would do, following the same decisions
+# as process_single
+async def plan_book(args, index, manifest, history, output_args):
+    book_key = os.path.abspath(args.INPUT_FILE_OR_DIR)
+    status = None
+    if manifest is not None and not args.target:
+        status = manifest.status(book_key, book_signature(
+            args.INPUT_FILE_OR_DIR, index), manifest_options(args))
+
+    entry = {
+        "name": index.name,
+        "path": book_key,
+        "status": status,
+        "action": "skip",
+        "output_file": None,
+        "codec": None,
+        "reason": None,
+        "duration": None,
+        "input_size": None,
+        "estimated_output_size": 0,
+        "estimated_encode_time": 0.0,
+    }
+
+    if (args.diff or args.update_metadata) and status == Manifest.UP_TO_DATE:
+        entry["output_file"] = manifest.lookup(book_key)[0]
+        return entry
+
+    config = load_config(args, os.path.abspath(index.path), index, output_args)
+    if len(config["input_files"]) == 0:
+        raise MkabookError("Could not find any input audio files")
+
+    entry["input_size"] = sum([os.path.getsize(x) for x in config["input_files"]])
+
+    # Every target gets its own entry, the book is converted once for all
+    # the targets needing it
+    if config["targets"]:
+        entry["status"] = None
+        entry["targets"] = []
+        for (target, manifest, _, status, action) in target_states(args, index, config, output_args):
+            if manifest is not None:
+                manifest.close()
+            entry["targets"].append({
+                "output_file": target["output_file"],
+                "status": status if status is not None or os.path.exists(target["output_file"]) else Manifest.NEW,
+                "action": action,
+                "config": target,
+            })
+        actions = [x["action"] for x in entry["targets"]]
+        entry["action"] = "convert" if "convert" in actions else (
+            "update" if "update" in actions else "skip")
+        entry["output_file"] = entry["targets"][0]["output_file"]
+    else:
+        entry["output_file"] = config["output_file"]
+        if status is None and not os.path.exists(config["output_file"]):
+            entry["status"] = Manifest.NEW
+        # Meta-data updates only rewrite the headers of the output
+        entry["action"] = book_action(args, status, config["output_file"])
+
+    if entry["action"] != "convert":
+        for target in entry.get("targets", []):
+            del target["config"]
+        return entry
+
+    try:
+        infos = await probe_files(config["input_files"], config)
+    except Exception:
+        infos = None
+    if infos is not None:
+        entry["duration"] = sum([x["duration"] for x in infos])
+
+    if not config["targets"]:
+        entry.update(plan_encode(config, infos, entry["duration"], entry["input_size"], history))
+        return entry
+
+    # The targets are encoded side by side from the same decode
+    sizes = []
+    times = []
+    for target in entry["targets"]:
+        target_config = target.pop("config")
+        if target["action"] != "convert":
+            continue
+        target.update(plan_encode(target_config, infos, entry["duration"], entry["input_size"], history))
+        sizes.append(target["estimated_output_size"])
+        times.append(target["estimated_encode_time"])
+    entry["estimated_output_size"] = None if None in sizes else sum(sizes)
+    entry["estimated_encode_time"] = None if None in times else max(times)
+
+    return entry
+
+
+# The codec a conversion uses and estimates of its output size and
+# encoding time
+def plan_encode(config, infos, duration, size, history):
+    (codec, reason) = (config["codec"], None)
+    if codec == "auto":
+        # The gain isn't known without measuring the loudness, which decodes
+        # the inputs
+        if config["normalize"]:
+            (codec, reason) = (config["auto_codec"], "normalizing the loudness")
+        else:
+            (codec, reason) = decide_codec(config, infos)
+
+    encode_time = None
+    if duration is not None and codec in history:
+        encode_time = duration / history[codec]["realtime_factor"]
+
+    return {
+        "codec": codec,
+        "reason": reason,
+        "estimated_output_size": estimate_output_size(config, codec, duration, size, history),
+        "estimated_encode_time": encode_time,
+    }
+
+
+# Size of a converted book, from its bitrate when one is set or otherwise
+# from earlier builds with the same codec
+def estimate_output_size(config, codec, duration, size, history):
+    if codec == "copy":
+        return size
+    if duration is None:
+        return None
+    if config["bitrate"]:
+        return int(duration * parse_bitrate(config["bitrate"]) / 8)
+    if codec in history:
+        return int(duration * history[codec]["output_bytes_per_second"])
+    if codec == "flac":
+        return int(duration * LOSSLESS_BYTES_PER_SECOND)
+    return None
+
+
+# Wall time of running tasks taking `times` on `jobs` workers, longest first
+# like run_batch does
+def schedule_time(times, jobs):
+    workers = [0.0] * jobs
+    for t in sorted(times, reverse=True):
+        workers[workers.index(min(workers))] += t
+    return max(workers)
+
+
+################################################################################
+#  Verification                                                                #
+################################################################################
+
+# Seconds, or part of the expected duration, an output may differ from the
+# total of its inputs. Lossy encoders pad the audio a little.
+VERIFY_DURATION_TOLERANCE = 1.0
+VERIFY_DURATION_RATIO = 0.005
+
+
+# Check the books recorded in the output directory's manifest. Broken books
+# are marked for rebuilding, which --batch then does straight away.
+def handle_verify(args):
+    if args.batch and args.INPUT_FILE_OR_DIR is None:
+        fail_msg("Rebuilding with --batch needs the input directory")
+        sys.exit(1)
+
+    try:
+        (failed, unlocated) = asyncio.run(verify_library(args))
+    except MkabookError as e:
+        fail_msg(e)
+        sys.exit(1)
+
+    print("")
+    if unlocated:
+        warn_msg("{} outputs were not found and are left as they are, run --verify from the directory they were built in".format(
+            len(unlocated)))
+        if not failed:
+            sys.exit(1)
+    if not failed:
+        good_msg("All outputs verified")
+        return
+
+    if args.batch:
+        fail_msg("{} outputs failed verification, rebuilding them".format(len(failed)))
+        args.diff = True
+        handle_batch(args)
+    else:
+        fail_msg("{} outputs failed verification, --diff will rebuild them".format(len(failed)))
+        sys.exit(1)
+
+
+# Verify every book of the manifest, or the ones below the input when given,
+# returning the books which failed and those whose output couldn't be found
+# but may exist relative to another directory
+async def verify_library(args):
+    output_dir = output_directory(args)
+    if not os.path.isfile(os.path.join(output_dir, Manifest.FILE_NAME)):
+        raise MkabookError(
+            "No books have been built into {}".format(output_dir))
+
+    manifest = Manifest(output_dir)
+    try:
+        books = manifest.books()
+        if args.INPUT_FILE_OR_DIR is not None:
+            root = os.path.abspath(args.INPUT_FILE_OR_DIR)
+            books = [x for x in books if x[0] ==
+                     root or x[0].startswith(root + os.sep)]
+
+        progress_msg("Verifying {} outputs{}".format(
+            len(books), ", decoding the audio" if args.verify_decode else ""))
+
+        limit = asyncio.Semaphore(available_cores())
+        failed = []
+        unlocated = []
+
+        async def verify_one(book, output_file, config, located):
+            name = os.path.basename(output_file)
+            # Never queue a rebuild for an output that is only not found
+            # because of the working directory
+            if not located:
+                warn_msg("The output can't be located: {}".format(
+                    output_file), prefix=name)
+                unlocated.append(book)
+                return
+
+            async with limit:
+                problems = await verify_book(args, manifest, output_file, config)
+            if problems:
+                fail_msg("\n\t".join(problems), prefix=name, file=sys.stdout)
+                manifest.invalidate(book)
+                failed.append(book)
+            else:
+                good_msg("OK", prefix=name)
+
+        await run_all([verify_one(*x) for x in books])
+    finally:
+        manifest.close()
+
+    return (failed, unlocated)
+
+
+# The problems with one output, from the cache when it hasn't changed since
+# it was last verified
+async def verify_book(args, manifest, output_file, config):
+    if config is None:
+        return ["The build of this output never finished"]
+
+    try:
+        st = os.stat(output_file)
+    except OSError:
+        return ["The output is missing"]
+
+    problems = manifest.lookup_verification(output_file, st, args.verify_decode)
+    if problems is None:
+        apply_cache_args(args, config)
+        problems = await verify_output(output_file, config, args.verify_decode)
+        manifest.record_verification(output_file, st, args.verify_decode, problems)
+
+    return problems
+
+
+# Check that an output is a readable Matroska file as long as its inputs,
+# with the chapters and cover it was built with. With `decode` all of the
+# audio is decoded as well.
+async def verify_output(output_file, config, decode):
+    (returncode, output) = await capture_process(["ffprobe", "-v", "error", "-print_format", "json",
+                                                  "-show_format", "-show_streams", "-show_chapters", output_file])
+    try:
+        info = json.loads(output)
+    except ValueError:
+        info = None
+    if returncode != 0 or info is None or "matroska" not in info.get("format", {}).get("format_name", ""):
+        return ["The Matroska header can't be read"]
+
+    problems = []
+    streams = info.get("streams", [])
+    if not [x for x in streams if x.get("codec_type") == "audio"]:
+        problems.append("There is no audio track")
+
+    # Inputs removed since the build can't be compared against
+    input_files = config.get("input_files") or []
+    expected = None
+    if input_files and all([os.path.isfile(x) for x in input_files]):
+        expected = await probe_total_duration(input_files, config)
+    # The duration in the header is written before the audio, so it is
+    # compared with the end of the last packet to find truncated files
+    duration = float(info["format"].get("duration", 0))
+    end = await last_packet_end(output_file, duration)
+    if end is None or end < duration - max(VERIFY_DURATION_TOLERANCE, duration * VERIFY_DURATION_RATIO):
+        problems.append("The output is truncated, its audio ends at {} of {}".format(
+            format_duration(end or 0), format_duration(duration)))
+    elif expected is not None and abs(duration - expected) > max(VERIFY_DURATION_TOLERANCE, expected * VERIFY_DURATION_RATIO):
+        problems.append("The audio is {} long, its inputs are {}".format(
+            format_duration(duration), format_duration(expected)))
+
+    if (config.get("chapter_file") or (config.get("auto_chapters") and len(input_files) > 1)) and not info.get("chapters"):
+        problems.append("The chapters are missing")
+
+    if config.get("cover_file") and not [x for x in streams if x.get("codec_type") == "attachment" and
+                                         x.get("tags", {}).get("mimetype", "").startswith("image/")]:
+        problems.append("The cover is missing")
+
+    if decode and not problems:
+        errors = []
+        (returncode, _) = await spawn(["ffmpeg", "-nostdin", "-v", "error", "-i", output_file,
+                                       "-map", "0:a", "-f", "null", "-"], lambda line: None, errors.append)
+        if returncode != 0 or errors:
+            problems.append("Decoding the audio failed: {}".format(
+                errors[0] if errors else "exit code {}".format(returncode)))
+
+    return problems
+
+
+# Seconds before the end of the header duration the last packets are read
+# from
+VERIFY_TAIL = 30
+
+
+# The time the audio of a file really ends at, from its last packet. Only the
+# end of the file is read when it can be seeked to, truncated files lose the
+# index needed for that and have all of their packets read, which still
+# doesn't decode anything.
+async def last_packet_end(path, duration):
+    for intervals in [["-read_intervals", "{}%".format(max(0, duration - VERIFY_TAIL))], []]:
+        (_, output) = await capture_process(["ffprobe", "-v", "quiet", "-select_streams", "a:0"] + intervals +
+                                            ["-show_entries", "packet=pts_time,duration_time", "-of", "csv=p=0", path])
+        end = None
+        for line in output.splitlines():
+            fields = line.strip().strip(",").split(",")
+            try:
+                end = max(end or 0, float(fields[0]) + (float(fields[1]) if len(fields) > 1 and fields[1] != "N/A" else 0))
+            except ValueError:
+                continue
+        if end is not None:
+            return end
+    return None
+
+
+################################################################################
+#  Watching                                                                    #
+################################################################################
+
+# Keep converting books as they land in the library. The manifest in the
+# output directory is the daemon's state, so after a restart only books
+# changed while it was down are rebuilt.
+def handle_watch(args):
+    if not os.path.isdir(args.INPUT_FILE_OR_DIR):
+        fail_msg("Input expected to be a directory")
+        sys.exit(1)
+
+    args.batch = True
+    args.diff = True
+    share_cores(args, available_cores())
+
+    metrics = Metrics(args.metrics_file) if args.metrics_file else None
+    try:
+        asyncio.run(watch_library(args, metrics))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        if metrics is not None:
+            metrics.close()
+
+
+async def watch_library(args, metrics=None):
+    root = args.INPUT_FILE_OR_DIR
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    # Directories with changes, and when they last changed
+    changed = {}
+    queue = asyncio.Queue()
+    queued = set()
+    running = set()
+
+    def mark(path):
+        changed[path] = loop.time()
+
+    def enqueue(path):
+        if path not in queued:
+            queued.add(path)
+            queue.put_nowait(path)
+
+    # A pool of workers living as long as the daemon
+    async def worker():
+        while True:
+            path = await queue.get()
+            queued.discard(path)
+            if path in running:
+                # Changed while it was being built, look again later
+                mark(path)
+                continue
+
+            running.add(path)
+            try:
+                book = await asyncio.to_thread(BookIndex, path)
+                if book.audio_files:
+                    book.name = " - ".join(os.path.relpath(path, root).split(os.sep))
+                    (name, ret) = await shim(args, book, metrics)
+                    report_result(name, ret)
+                elif path != root:
+                    # A series moved or copied in arrives as one event, its
+                    # books have to be found below it
+                    for nested in await index_library(path):
+                        mark(nested.path)
+            except OSError:
+                # The directory went away before it was processed
+                pass
+            finally:
+                running.discard(path)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(args.jobs)]
+
+    watcher = None
+    if not args.poll:
+        try:
+            watcher = Inotify()
+        except OSError as e:
+            warn_msg("Could not use inotify, polling instead: {}".format(e))
+
+    # Anything that changed while no daemon was running
+    books = await index_library(root)
+    signatures = {x.path: x.signature() for x in books}
+    for book in books:
+        enqueue(book.path)
+
+    rescan = False
+    if watcher is not None:
+        try:
+            watcher.watch_tree(root, True)
+        except OSError as e:
+            warn_msg("Could not watch the library, polling instead: {}".format(e))
+            watcher.close()
+            watcher = None
+
+    if watcher is not None:
+        def on_events():
+            nonlocal rescan
+            for (path, name, mask) in watcher.read():
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    rescan = True
+                elif path is None or name.startswith("."):
+                    continue
+                elif mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    # New books and series are watched from the start
+                    try:
+                        watcher.watch_tree(os.path.join(path, name))
+                    except OSError:
+                        pass
+                    mark(os.path.join(path, name))
+                else:
+                    mark(path)
+
+        loop.add_reader(watcher.fd, on_events)
+        good_msg("Watching {} for changes".format(root))
+    else:
+        good_msg("Polling {} for changes every {}s".format(
+            root, args.poll_interval))
+
+    next_poll = loop.time() + args.poll_interval
+    try:
+        while True:
+            await asyncio.sleep(min(1, args.settle))
+
+            # Rescanning marks every book whose files differ from the last scan
+            if (watcher is None and loop.time() >= next_poll) or rescan:
+                rescan = False
+                next_poll = loop.time() + args.poll_interval
+                for book in await index_library(root):
+                    signature = book.signature()
+                    if signatures.get(book.path) != signature:
+                        signatures[book.path] = signature
+                        mark(book.path)
+
+            # Books are queued once their files have settled
+            now = loop.time()
+            for (path, last) in list(changed.items()):
+                if now - last >= args.settle:
+                    del changed[path]
+                    enqueue(path)
+    finally:
+        for task in workers:
+            task.cancel()
+        if watcher is not None:
+            loop.remove_reader(watcher.fd)
+            watcher.close()
+
+
+# Minimal inotify binding through ctypes
+class Inotify:
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    # Writes keep a book from settling while a file is still being copied
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+            | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(),
+                          os.strerror(ctypes.get_errno()))
+        self.watches = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(path), Inotify.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(
+                ctypes.get_errno()), path)
+        self.watches[wd] = path
+
+    # Watch a directory, and the directories below it down to the books.
+    # Like the library index, links are only followed at the top.
+    def watch_tree(self, path, top=False):
+        self.watch(path)
+        index = BookIndex(path)
+        if not index.audio_files:
+            for directory in index.directories + (index.links if top else []):
+                self.watch_tree(directory)
+
+    # The (directory, name, mask) of every pending event
+    def read(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, _, length) = Inotify.EVENT.unpack_from(data, offset)
+            offset += Inotify.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & Inotify.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            events.append((self.watches.get(wd), name, mask))
+
+        return events
+
 
 ################################################################################
 #  Subprocess Handling                                                         #
 ################################################################################
 
-def poll_process(msg, args, verbose_output=False, dynamic_output=True, prefix=None, poll_time=0.25):
+# How often the spinner is redrawn
+SPINNER_INTERVAL = 0.25
+# Lines of stderr kept to show when a process fails
+STDERR_TAIL_LINES = 200
+# Longest line read from a process, anything longer is dropped
+PIPE_LINE_LIMIT = 1024 * 1024
+
+
+# Run a process to completion from the event loop, showing its progress.
+# `duration` is the length in seconds of the audio ffmpeg will produce, and
+# turns its progress reports into a percentage and ETA.
+# Timings are recorded into `metrics` under `stage`, which defaults to `msg`.
+async def run_process(msg, args, verbose_output=False, dynamic_output=True, prefix=None, duration=None, stage=None, metrics=None, events=None):
     raw_msg = msg
     # Useful constant
     POLL_STAGES = ["▖", "▘", "▝", "▗"]
-    # Build args for redirecting output if we don't want verbose output
-    REDIRECT = {}
-    if not verbose_output:
-        REDIRECT = {
-            "stdout": subprocess.PIPE,
-            "stderr": subprocess.PIPE,
-        }
-    else:
+
+    if verbose_output:
         # Verbose ouptut implies no dynamic messages
         dynamic_output = False
 
@@ -419,37 +3594,232 @@ def poll_process(msg, args, verbose_output=False, dynamic_output=True, prefix=No
         msg = "{}: {}".format(prefix, msg)
 
     if not dynamic_output:
-        progress_msg(msg)
+        progress_msg(raw_msg, prefix=prefix, events=events)
 
-    # Spawn the process
-    proc = subprocess.Popen(args, **REDIRECT)
+    # ffmpeg reports its progress as key=value lines on stdout
+    progress = Progress(duration)
+    if os.path.basename(args[0]) == "ffmpeg" and not verbose_output:
+        args = [args[0], "-progress", "pipe:1", "-nostats"] + args[1:]
 
-    # Wait for the process to terminate, maybe updating the spinner
-    if not dynamic_output:
-        proc.wait()
-    else:
+    stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+    last_reported = [0]
+
+    def on_stdout(line):
+        if not progress.update(line):
+            return
+
+        if events is not None:
+            events("progress", "{} {}".format(raw_msg, progress), prefix)
+        elif not dynamic_output and progress.percent is not None:
+            # Only report every quarter of the way when printing line by line
+            if progress.percent >= last_reported[0] + 25 and progress.percent < 100:
+                last_reported[0] = progress.percent - progress.percent % 25
+                progress_msg("{} {}".format(msg, progress))
+
+    async def spin():
         poll_step = 0
         while True:
-            print("[" + bcolors.OKCYAN + POLL_STAGES[poll_step %
-                                                     4] + bcolors.ENDC + "] {}".format(msg), end="\r")
-
-            time.sleep(poll_time)
+            print("[" + bcolors.OKCYAN + POLL_STAGES[poll_step % 4] + bcolors.ENDC + "] {} {}\033[K".format(
+                msg, progress), end="\r")
             poll_step += 1
+            await asyncio.sleep(SPINNER_INTERVAL)
 
-            if proc.poll() is not None:
-                break
+    spinner = asyncio.ensure_future(spin()) if dynamic_output else None
+    start = time.monotonic()
+    try:
+        if verbose_output:
+            (returncode, usage) = await spawn(args)
+        else:
+            (returncode, usage) = await spawn(args, on_stdout, stderr_tail.append)
+    finally:
+        if spinner is not None:
+            spinner.cancel()
+            print("\r\033[K", end="")
+
+    if metrics is not None:
+        metrics.stage(stage or raw_msg, time.monotonic() -
+                      start, usage, duration, returncode)
 
     # Check what happened to the sub-process and print that out
-    if proc.returncode == 0:
-        good_msg(msg)
+    if returncode == 0:
+        good_msg(raw_msg, prefix=prefix, events=events)
     else:
-        fail_msg(msg)
+        fail_msg(raw_msg, prefix=prefix, events=events)
         # Dump the captured output if we weren't already in verbose mode
-        if not verbose_output:
-            for line in proc.stderr.readlines():
-                print("\t" + line.decode("utf-8"), file=sys.stderr, end="")
+        if events is None:
+            for line in stderr_tail:
+                print("\t" + line, file=sys.stderr)
         # Exit
-        raise Exception("Subprocess returned error while: {}".format(raw_msg))
+        error = MkabookError(
+            "Subprocess returned error while: {}".format(raw_msg))
+        error.stderr = list(stderr_tail)
+        raise error
+
+
+# Run a process without showing anything, returning its exit code and stdout
+async def capture_process(args):
+    stdout = []
+    (returncode, _) = await spawn(args, stdout.append, lambda line: None)
+    return (returncode, "\n".join(stdout))
+
+
+# Spawn a process and hand its output to the callbacks line by line until it
+# exits. The pipes are drained continuously, so a chatty process can never
+# block on a full pipe. Outputs without a callback are inherited.
+# Returns the exit code and resource usage of the process.
+async def spawn(args, on_stdout=None, on_stderr=None):
+    loop = asyncio.get_running_loop()
+    proc = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE if on_stdout else None,
+                            stderr=subprocess.PIPE if on_stderr else None)
+
+    # Reaping happens on a thread so the resource usage can be collected
+    exited = loop.create_future()
+    threading.Thread(target=wait_for_exit, args=(
+        loop, proc, exited), daemon=True).start()
+
+    transports = []
+    try:
+        readers = []
+        for (pipe, callback) in [(proc.stdout, on_stdout), (proc.stderr, on_stderr)]:
+            if callback is not None:
+                reader = asyncio.StreamReader(limit=PIPE_LINE_LIMIT)
+                (transport, _) = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+                transports.append(transport)
+                readers.append(drain(reader, callback))
+
+        await asyncio.gather(*readers)
+        return await asyncio.shield(exited)
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+        await asyncio.shield(exited)
+        raise
+    finally:
+        for transport in transports:
+            transport.close()
+
+
+async def drain(reader, callback):
+    while True:
+        try:
+            line = await reader.readline()
+        except ValueError:
+            # The line was longer than the limit and has been discarded
+            continue
+        if not line:
+            break
+        callback(line.decode("utf-8", errors="replace").rstrip("\r\n"))
+
+
+def wait_for_exit(loop, proc, future):
+    # An exited child stays a zombie until it is reaped, which leaves its I/O
+    # counters readable on Linux
+    io = {}
+    try:
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        with open("/proc/{}/io".format(proc.pid), "r") as f:
+            for line in f:
+                (key, value) = line.split(":", 1)
+                io[key] = int(value)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+    (_, status, rusage) = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    usage = {
+        "cpu_time": rusage.ru_utime + rusage.ru_stime,
+        "bytes_read": io.get("rchar", rusage.ru_inblock * 512),
+        "bytes_written": io.get("wchar", rusage.ru_oublock * 512),
+    }
+
+    def set_result():
+        if not future.done():
+            future.set_result((proc.returncode, usage))
+
+    try:
+        loop.call_soon_threadsafe(set_result)
+    except RuntimeError:
+        # The loop was closed while the process ran
+        pass
+
+
+# Await several coroutines, if one fails the others are cancelled
+async def run_all(coros):
+    tasks = [asyncio.ensure_future(x) for x in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+# Progress of a running process, from ffmpeg's -progress output or
+# mkvmerge's "Progress: N%" lines
+class Progress:
+    def __init__(self, duration=None):
+        self.duration = duration
+        self.position = None
+        self.speed = None
+        self.percent = None
+
+    # Returns True once a complete progress report has been read
+    def update(self, line):
+        matches = re.findall(r"Progress: (\d+)%", line)
+        if matches:
+            self.percent = int(matches[-1])
+            return True
+
+        if "=" not in line:
+            return False
+
+        (key, value) = line.split("=", 1)
+        value = value.strip()
+        # Despite the name out_time_ms is also in microseconds
+        if key in ["out_time_us", "out_time_ms"]:
+            try:
+                self.position = int(value) / 1000000
+            except ValueError:
+                pass
+        elif key == "speed":
+            try:
+                self.speed = float(value.rstrip("x"))
+            except ValueError:
+                pass
+        elif key == "progress":
+            if self.duration and self.position is not None:
+                self.percent = max(
+                    0, min(100, int(100 * self.position / self.duration)))
+            if value == "end" and self.duration:
+                self.percent = 100
+            return True
+
+        return False
+
+    # Seconds until the process finishes at its current speed
+    def eta(self):
+        if self.duration and self.position is not None and self.speed:
+            return max(0, (self.duration - self.position) / self.speed)
+        return None
+
+    def __str__(self):
+        parts = []
+        if self.percent is not None:
+            parts.append("{}%".format(self.percent))
+        if self.speed:
+            parts.append("{:.1f}x".format(self.speed))
+        eta = self.eta()
+        if eta is not None:
+            parts.append("ETA " + format_duration(eta))
+        return " ".join(parts)
+
+
+# Format seconds as H:MM:SS
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "{}:{:02}:{:02}".format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
 
 ################################################################################
 #  Debug Messages                                                              #
@@ -468,8 +3838,15 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
+# Every message goes to the console unless an `events` callback is given,
+# which is then called with the kind of message ("progress", "good", "fail",
+# or "warn"), the message, and the prefix
+
 # Print that we started an item to the console
-def progress_msg(msg, prefix=None, **kwargs):
+def progress_msg(msg, prefix=None, events=None, **kwargs):
+    if events is not None:
+        return events("progress", msg, prefix)
+
     START = bcolors.OKCYAN + "=" + bcolors.ENDC
     if prefix is not None:
         print("[" + START + "] {}: {}".format(prefix, msg))
@@ -478,7 +3855,10 @@ def progress_msg(msg, prefix=None, **kwargs):
 
 
 # Print a success message to the console
-def good_msg(msg, prefix=None, **kwargs):
+def good_msg(msg, prefix=None, events=None, **kwargs):
+    if events is not None:
+        return events("good", msg, prefix)
+
     GOOD = bcolors.OKGREEN + "✓" + bcolors.ENDC
 
     if prefix is not None:
@@ -489,7 +3869,10 @@ def good_msg(msg, prefix=None, **kwargs):
 # Print a message indicating failure to a file (default stderr)
 
 
-def fail_msg(msg, file=sys.stderr, prefix=None, **kwargs):
+def fail_msg(msg, file=sys.stderr, prefix=None, events=None, **kwargs):
+    if events is not None:
+        return events("fail", msg, prefix)
+
     FAIL = bcolors.FAIL + "🗴" + bcolors.ENDC
 
     if prefix is not None:
@@ -499,7 +3882,10 @@ def fail_msg(msg, file=sys.stderr, prefix=None, **kwargs):
 
 
 # Print a warning message to the console
-def warn_msg(msg, prefix=None, **kwargs):
+def warn_msg(msg, prefix=None, events=None, **kwargs):
+    if events is not None:
+        return events("warn", msg, prefix)
+
     WARN = bcolors.WARNING + "?" + bcolors.ENDC
 
     if prefix is not None:
@@ -524,9 +3910,12 @@ class Chapters:
 </Chapters>
 """
 
-    def __init__(self, chapter_file):
+    def __init__(self, chapter_file=None):
         self.chapters = []
         chap_stack = []
+        if chapter_file is None:
+            return
+
         with open(chapter_file, 'r') as input:
             # Each line should be a chapter => ChapterAtom
             for line in input.readlines():
@@ -577,14 +3966,15 @@ class Chapter:
         self.children.append(child)
 
     def write(self, file, sub_level, config):
+        title = xml.sax.saxutils.escape(self.title)
         if config['use_sub_chapters']:
-            file.write(Chapter.XML_ENTRY_FORMAT.format(self.start, self.title))
+            file.write(Chapter.XML_ENTRY_FORMAT.format(self.start, title))
             for child in self.children:
                 child.write(file, sub_level + 1, config)
             file.write(Chapter.XML_ENTRY_CLOSE)
         else:
             file.write(Chapter.XML_ENTRY_FORMAT.format(
-                self.start, '\t'*sub_level + self.title))
+                self.start, '\t'*sub_level + title))
             file.write(Chapter.XML_ENTRY_CLOSE)
             for child in self.children:
                 child.write(file, sub_level + 1, config)
@@ -597,18 +3987,45 @@ class Chapter:
 def main():
     args = parse_args()
 
-    if args.batch:
+    if args.prune_cache:
+        handle_prune_cache(args)
+        return
+
+    # Without an input every output in the manifest is verified
+    if args.verify or args.verify_decode:
+        handle_verify(args)
+        return
+
+    if args.INPUT_FILE_OR_DIR is None:
+        fail_msg("An input file or directory is required")
+        sys.exit(1)
+
+    if args.split:
+        try:
+            handle_split(args)
+        except Exception as e:
+            print(e)
+            sys.exit(1)
+    elif args.plan:
+        handle_plan(args)
+    elif args.watch:
+        handle_watch(args)
+    elif args.batch:
         handle_batch(args)
     else:
+        metrics = Metrics(args.metrics_file) if args.metrics_file else None
         try:
             handle_single(args, output_args={
                 "prefix": None,
                 "verbose_output": args.v,
                 "dynamic_output": True
-            })
+            }, metrics=metrics)
         except Exception as e:
             print(e)
             sys.exit(1)
+        finally:
+            if metrics is not None:
+                metrics.close()
 
 
 if __name__ == "__main__":